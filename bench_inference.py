@@ -0,0 +1,46 @@
+# model.predictと推論器の1局面あたりのレイテンシの比較
+from dual_network import DN_INPUT_SHAPE, dual_network
+from game import State, random_action
+from inference import Predictor
+from tensorflow.keras.models import load_model
+import numpy as np
+import time
+
+# パラメータ
+BI_CALL_COUNT = 200  # 計測する推論回数
+
+# 計測用の局面の生成
+def sample_states(n):
+    states = []
+    while len(states) < n:
+        state = State()
+        while not state.is_done() and len(states) < n:
+            states.append(state)
+            state = state.next(random_action(state))
+    return states
+
+# 1回あたりの推論時間(ミリ秒)の計測
+def bench(func, states):
+    func(states[0])  # ウォームアップ(トレース)
+    start = time.perf_counter()
+    for state in states:
+        func(state)
+    return (time.perf_counter() - start) / len(states) * 1000
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+    model = load_model('./model/best.h5', compile=False)
+    predictor = Predictor(model, cache=None)
+    states = sample_states(BI_CALL_COUNT)
+
+    # 従来の推論(1回ごとにmodel.predict)
+    def keras_predict(state):
+        a, b, c = DN_INPUT_SHAPE
+        x = np.array([state.pieces, state.enemy_pieces])
+        x = x.reshape(c, a, b).transpose(1, 2, 0).reshape(1, a, b, c)
+        return model.predict(x, batch_size=1, verbose=0)
+
+    t0 = bench(keras_predict, states)
+    t1 = bench(predictor.predict, states)
+    print('model.predict: {:.2f}ms, Predictor: {:.2f}ms, x{:.1f}'.format(t0, t1, t0 / t1))
@@ -0,0 +1,34 @@
+# 葉ノードのまとめ評価の件数ごとのシミュレーション速度の比較
+from dual_network import dual_network
+from game import State
+from inference import Predictor
+from pv_mcts import MCTSTree
+from bench_inference import sample_states
+from tensorflow.keras.models import load_model
+import time
+
+# パラメータ
+BM_SIMULATION_COUNT = 400             # 1探索あたりのシミュレーション回数
+BM_STATE_COUNT = 5                    # 計測する局面数
+BM_BATCH_SIZES = (1, 2, 4, 8, 16, 32) # 比較する1回の推論あたりの葉ノード数
+
+# 1秒あたりのシミュレーション回数の計測
+def bench(predictor, states, batch_size):
+    tree = MCTSTree()
+    tree.reset(State())
+    tree.search(predictor, 8, batch_size)  # ウォームアップ(トレース)
+    start = time.perf_counter()
+    for state in states:
+        tree.reset(state)
+        tree.search(predictor, BM_SIMULATION_COUNT, batch_size)
+    return BM_SIMULATION_COUNT * len(states) / (time.perf_counter() - start)
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+    model = load_model('./model/best.h5', compile=False)
+    predictor = Predictor(model, cache=None)  # キャッシュなしでネットワークの推論を計測
+    states = sample_states(BM_STATE_COUNT)
+
+    for batch_size in BM_BATCH_SIZES:
+        print('Batch {:2d}: {:.1f} simulations/sec'.format(batch_size, bench(predictor, states, batch_size)))
@@ -0,0 +1,60 @@
+# Keras(tf.function)とNumPyの推論の一致の確認と、レイテンシ・スループットの比較
+from dual_network import DN_INPUT_SHAPE, dual_network
+from game import canonical_states
+from inference import load_predictor, encode_batch
+from numpy_inference import load_numpy_predictor
+import numpy as np
+import time
+
+# パラメータ
+BN_BATCH_SIZES = (1, 8, 64, 256)  # 計測するバッチサイズ
+BN_SECONDS = 2.0                  # バッチサイズごとの計測時間
+BN_TOLERANCE = 1e-4               # 一致とみなす出力の差の上限
+
+# 全局面の入力データ
+def all_inputs():
+    states = list(canonical_states().values())
+    x = np.zeros((len(states), *DN_INPUT_SHAPE), dtype=np.float32)
+    encode_batch(states, x)
+    return x
+
+# 2つの推論器の出力の最大の差(方策、価値)
+def max_difference(a, b, x, batch_size=256):
+    dp = dv = 0.0
+    for i in range(0, len(x), batch_size):
+        pa, va = a.predict_array(x[i:i + batch_size])
+        pb, vb = b.predict_array(x[i:i + batch_size])
+        dp = max(dp, float(np.abs(pa - pb).max()))
+        dv = max(dv, float(np.abs(va - vb).max()))
+    return dp, dv
+
+# 1バッチあたりの推論時間(ミリ秒)
+def bench(predictor, x, batch_size):
+    batches = [x[i:i + batch_size] for i in range(0, len(x) - batch_size + 1, batch_size)] or [x[:batch_size]]
+    predictor.predict_array(batches[0])  # ウォームアップ(トレース)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < BN_SECONDS:
+        predictor.predict_array(batches[count % len(batches)])
+        count += 1
+    return (time.perf_counter() - start) / count * 1000
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+    keras = load_predictor('./model/best.h5', cache=None)
+    numpy = load_numpy_predictor('./model/best.h5', cache=None)
+    x = all_inputs()
+
+    # 一致の確認(全局面、バッチサイズを変えても同じ出力になること)
+    for batch_size in (1, 7, 256):
+        dp, dv = max_difference(keras, numpy, x, batch_size)
+        print('Batch {}: max |dp| {:.2e}, max |dv| {:.2e}'.format(batch_size, dp, dv))
+        assert dp < BN_TOLERANCE and dv < BN_TOLERANCE, 'NumPy outputs differ from Keras'
+
+    # レイテンシとスループット
+    for batch_size in BN_BATCH_SIZES:
+        t0 = bench(keras, x, batch_size)
+        t1 = bench(numpy, x, batch_size)
+        print('Batch {}: Keras {:.3f}ms ({:.0f} pos/sec), NumPy {:.3f}ms ({:.0f} pos/sec), x{:.1f}'.format(
+            batch_size, t0, batch_size / t0 * 1000, t1, batch_size / t1 * 1000, t0 / t1))
@@ -0,0 +1,115 @@
+# アーキテクチャのプリセットごとの推論速度と、一定回数の学習サイクル後の強さの比較
+from dual_network import DN_PRESETS, DN_INPUT_SHAPE, preset_config, build_model, dual_network
+from game import canonical_states
+from inference import Predictor, encode_batch
+from numpy_inference import NumpyNetwork, NumpyPredictor, export_weights
+from match import run_matches, pv_mcts_player, print_progress, TABLEBASE_PLAYER, MT_WORKERS
+from tablebase import load_tablebase
+from pathlib import Path
+import numpy as np
+import tempfile
+import time
+import sys
+import os
+
+# パラメータ
+BP_PRESETS = tuple(DN_PRESETS)  # 比較するプリセット
+BP_BATCH_SIZE = 64              # スループットを計測するバッチサイズ
+BP_SECONDS = 2.0                # 計測ごとの時間
+BP_CYCLES = 3                   # 強さを比べるまでの学習サイクル数
+BP_GAME_COUNT = 10              # 完全解析のプレイヤーとのゲーム数
+BP_BACKEND = 'numpy'            # 学習サイクルと対戦の推論の方法
+BP_DIR = './bench_presets/'     # プリセットごとの学習サイクルの作業ディレクトリ
+
+# 1バッチあたりの推論時間(ミリ秒)
+def bench(predictor, x):
+    predictor.predict_array(x)  # ウォームアップ(トレース)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < BP_SECONDS:
+        predictor.predict_array(x)
+        count += 1
+    return (time.perf_counter() - start) / count * 1000
+
+# プリセットごとの1局面のレイテンシとバッチのスループット(未学習のモデル)
+def bench_speed(preset, x):
+    model = build_model(preset_config(preset))
+    with tempfile.TemporaryDirectory() as tmp:
+        weights = export_weights(model, os.path.join(tmp, 'weights.npz'))
+    predictors = {'Keras': Predictor(model, cache=None), 'NumPy': NumpyPredictor(NumpyNetwork(weights), cache=None)}
+    results = []
+    for label, predictor in predictors.items():
+        latency = bench(predictor, x[:1])
+        batch = bench(predictor, x[:BP_BATCH_SIZE])
+        results.append('{} {:.3f}ms/pos, {:.0f} pos/sec at batch {}'.format(
+            label, latency, BP_BATCH_SIZE / batch * 1000, BP_BATCH_SIZE))
+    print('{}: {} params, {}'.format(preset, model.count_params(), '; '.join(results)))
+
+# 完全解析との一致度(最善手を選ぶ割合と価値の平均絶対誤差)
+def audit_predictor(predictor, tablebase):
+    states = list(canonical_states().values())
+    policies, values = predictor.predict_batch(states)
+    top1 = value_error = 0.0
+    for state, policy, value in zip(states, policies, values):
+        best_value, best_actions, _ = tablebase.lookup(state)
+        top1 += int(np.argmax(policy)) in best_actions
+        value_error += abs(value - best_value)
+    return top1 / len(states), value_error / len(states)
+
+# プリセットごとの学習サイクルの実行と強さの評価(作業ディレクトリはプリセットごとに分ける)
+def bench_strength(preset, tablebase):
+    import self_play
+    import evaluate_network
+    from train_network import train_network
+    from numpy_inference import load_numpy_predictor
+    from inference import EVAL_CACHE
+    from pv_mcts import ROOT_CACHE
+    backends = self_play.SP_BACKEND, evaluate_network.EN_BACKEND
+    self_play.SP_BACKEND = BP_BACKEND
+    evaluate_network.EN_BACKEND = BP_BACKEND
+
+    # 前のプリセットのモデルのキャッシュのエントリを持ち越さない
+    EVAL_CACHE.invalidate()
+    ROOT_CACHE.invalidate()
+
+    cwd = os.getcwd()
+    work_dir = Path(BP_DIR) / preset
+    work_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        dual_network(preset)
+        for i in range(BP_CYCLES):
+            print('{} cycle {} ========================='.format(preset, i))
+            self_play.self_play()
+            train_network()
+            evaluate_network.evaluate_network()
+        elapsed = time.perf_counter() - start
+
+        top1, value_error = audit_predictor(load_numpy_predictor('./model/best.h5', cache=None), tablebase)
+        point = run_matches({'VS_Perfect': (pv_mcts_player('./model/best.h5', 0.0, backend=BP_BACKEND), TABLEBASE_PLAYER)},
+                            BP_GAME_COUNT, MT_WORKERS, print_progress)['VS_Perfect']
+    finally:
+        os.chdir(cwd)
+        self_play.SP_BACKEND, evaluate_network.EN_BACKEND = backends
+    return elapsed, top1, value_error, point
+
+# 動作確認(引数でプリセットを指定、"speed"なら速度だけ計測)
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    presets = [a for a in args if a in DN_PRESETS] or BP_PRESETS
+    states = list(canonical_states().values())
+    x = np.zeros((len(states), *DN_INPUT_SHAPE), dtype=np.float32)
+    encode_batch(states, x)
+
+    # 推論速度
+    for preset in presets:
+        bench_speed(preset, x)
+
+    # 一定回数の学習サイクル後の強さ(VS_Perfectは0.5で完全解析と全て引き分け)
+    if 'speed' not in args:
+        tablebase = load_tablebase()
+        results = {preset: bench_strength(preset, tablebase) for preset in presets}
+        for preset, (elapsed, top1, value_error, point) in results.items():
+            print('{}: {} cycles in {:.1f}s, best move {:.3f}, value MAE {:.3f}, VS_Perfect {:.3f}'.format(
+                preset, BP_CYCLES, elapsed, top1, value_error, point))
@@ -0,0 +1,55 @@
+# 量子化した推論(float16、int8)とfloat32の比較(出力の差、同じゲームの組での対戦成績、速度とメモリ)
+from dual_network import dual_network
+from numpy_inference import load_numpy_predictor, weights_path, calibration_inputs
+from bench_numpy_inference import all_inputs, bench
+from match import MatchRunner, MT_WORKERS, pv_mcts_player, print_progress
+import numpy as np
+import os
+
+# パラメータ
+BQ_PRECISIONS = ('float16', 'int8')  # float32と比較する精度
+BQ_BATCH_SIZES = (1, 8, 64)          # 計測するバッチサイズ
+BQ_GAME_COUNT = 20                   # 対戦のゲーム数(先後を交互に入れ替える)
+BQ_TEMPERATURE = 1.0                 # 対戦の温度パラメータ
+BQ_SEED = 0                          # 対戦の乱数の種(ゲームの番号ごとに固定して同じゲームの組にする)
+BQ_WORKERS = MT_WORKERS              # 対戦を並列に実行するプロセス数
+
+# 出力の差の出力(方策と価値の最大・平均の差、最善手の一致率)
+def report_deviation(label, reference, predictor, x):
+    p0, v0 = reference.predict_array(x)
+    p, v = predictor.predict_array(x)
+    dp, dv = np.abs(p - p0), np.abs(v - v0)
+    print('  {}: |dp| max {:.2e} mean {:.2e}, |dv| max {:.2e} mean {:.2e}, top-1 agreement {:.3f}'.format(
+        label, dp.max(), dp.mean(), dv.max(), dv.mean(), (p.argmax(axis=1) == p0.argmax(axis=1)).mean()))
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+    path = './model/best.h5'
+    reference = load_numpy_predictor(path, cache=None)
+    predictors = {precision: load_numpy_predictor(path, precision, cache=None) for precision in BQ_PRECISIONS}
+    positions = {'all positions': all_inputs(), 'calibration': calibration_inputs()}
+
+    # 速度とメモリ
+    times = {size: bench(reference, positions['calibration'], size) for size in BQ_BATCH_SIZES}
+    print('float32: weights {:.1f}MB ({:.1f}MB file), {}'.format(
+        reference.call.nbytes() / 2 ** 20, os.path.getsize(weights_path(path)) / 2 ** 20,
+        ', '.join('batch {} {:.3f}ms'.format(size, t) for size, t in times.items())))
+    for precision, predictor in predictors.items():
+        speed = ', '.join('batch {} {:.3f}ms (x{:.2f})'.format(size, t, times[size] / t) for size, t in (
+            (size, bench(predictor, positions['calibration'], size)) for size in BQ_BATCH_SIZES))
+        print('{}: weights {:.1f}MB stored (x{:.2f} smaller, {:.1f}MB file), {:.1f}MB resident with float32 matmul copies, {}'.format(
+            precision, predictor.call.nbytes() / 2 ** 20, reference.call.nbytes() / predictor.call.nbytes(),
+            os.path.getsize(weights_path(path, precision)) / 2 ** 20, predictor.call.resident_nbytes() / 2 ** 20, speed))
+        for label, x in positions.items():
+            report_deviation(label, reference, predictor, x)
+
+    # 同じゲームの組でのfloat32との対戦(量子化したプレイヤーの平均ポイント)
+    float32 = pv_mcts_player(path, BQ_TEMPERATURE, backend='numpy')
+    pairings = {precision: (pv_mcts_player(path, BQ_TEMPERATURE, backend=precision), float32)
+                for precision in BQ_PRECISIONS}
+    with MatchRunner(BQ_WORKERS) as runner:
+        points = runner.play(pairings, range(BQ_GAME_COUNT), print_progress, seed=BQ_SEED)
+    for precision, p in points.items():
+        print('{} vs float32: W/D/L {}/{}/{}, average point {:.3f}'.format(
+            precision, p.count(1), p.count(0.5), p.count(0), sum(p) / len(p)))
@@ -0,0 +1,27 @@
+# 同時に進行するゲーム数ごとの自己対戦の速度の比較
+from dual_network import dual_network
+from inference import Predictor
+from self_play import play_lockstep
+from tensorflow.keras.models import load_model
+import time
+
+# パラメータ
+BP_GAME_COUNT = 16                # 計測するゲーム数
+BP_PARALLEL = (1, 2, 4, 8, 16)    # 比較する同時進行数
+
+# 1秒あたりのゲーム数の計測
+def bench(predictor, parallel):
+    start = time.perf_counter()
+    histories, _ = play_lockstep(predictor, BP_GAME_COUNT, parallel)
+    assert len(histories) == BP_GAME_COUNT
+    return BP_GAME_COUNT / (time.perf_counter() - start)
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+    model = load_model('./model/best.h5', compile=False)
+    predictor = Predictor(model, cache=None)  # キャッシュなしでネットワークの推論を計測
+    play_lockstep(predictor, 1, 1)            # ウォームアップ(トレース)
+
+    for parallel in BP_PARALLEL:
+        print('Parallel {:2d}: {:.2f} games/sec'.format(parallel, bench(predictor, parallel)))
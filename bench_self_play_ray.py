@@ -0,0 +1,36 @@
+# Rayのワーカー数ごとの自己対戦の速度とスケーリング効率の比較
+from dual_network import dual_network
+from self_play_ray import start_workers, stop_workers, play_distributed
+import os
+import time
+
+# パラメータ
+BR_GAME_COUNT = 32  # 計測するゲーム数
+
+# 1秒あたりのゲーム数の計測(ワーカーの起動とモデルの読み込みは含めない)
+def bench(worker_count):
+    workers = start_workers(worker_count)
+    try:
+        start = time.perf_counter()
+        play_distributed(workers, BR_GAME_COUNT)
+        return BR_GAME_COUNT / (time.perf_counter() - start)
+    finally:
+        stop_workers(workers)
+
+# 動作確認
+if __name__ == '__main__':
+    dual_network()
+
+    # 1からCPUコア数までのワーカー数
+    counts = [1]
+    while counts[-1] * 2 < os.cpu_count():
+        counts.append(counts[-1] * 2)
+    if counts[-1] != os.cpu_count():
+        counts.append(os.cpu_count())
+
+    base = None
+    for count in counts:
+        speed = bench(count)
+        base = base or speed
+        print('Workers {:2d}: {:.2f} games/sec, speedup x{:.2f}, efficiency {:.1%}'.format(
+            count, speed, speed / base, speed / base / count))
@@ -0,0 +1,35 @@
+# リスト版とビットボード版の状態の速度比較
+from game import ListState, BitState, random_action, alpha_beta
+import random
+import time
+
+# パラメータ
+BS_GAME_COUNT = 20000  # ランダム対戦のゲーム数
+
+# ランダム対戦の実行時間の計測
+def bench_random_games(state_class):
+    random.seed(0)
+    start = time.perf_counter()
+    for _ in range(BS_GAME_COUNT):
+        state = state_class()
+        while not state.is_done():
+            state = state.next(random_action(state))
+            state.is_first_player()
+    return time.perf_counter() - start
+
+# α-β法の実行時間の計測
+def bench_alpha_beta(state_class):
+    start = time.perf_counter()
+    alpha_beta(state_class(), -float('inf'), float('inf'))
+    return time.perf_counter() - start
+
+# 両方の状態クラスで計測して出力
+def bench(label, func):
+    t0 = func(ListState)
+    t1 = func(BitState)
+    print('{}: list {:.3f}s, bitboard {:.3f}s, x{:.1f}'.format(label, t0, t1, t0 / t1))
+
+# 動作確認
+if __name__ == '__main__':
+    bench('Random {} games'.format(BS_GAME_COUNT), bench_random_games)
+    bench('Alpha-beta from empty board', bench_alpha_beta)
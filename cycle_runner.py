@@ -0,0 +1,198 @@
+# モデルを常駐させた学習サイクル(ベストと候補のモデルをプロセス内に保持し、段階間は重みをメモリで受け渡す)
+# 昇格はモデルの参照の入れ替えで行い、チェックポイントはバックグラウンドのスレッドで書き出す
+from dual_network import dual_network, build_model, load_config, save_config
+from inference import Predictor
+from numpy_inference import NumpyNetwork, NumpyPredictor, fold_weights
+from self_play import self_play
+from train_network import train_network
+from evaluate_network import evaluate_network
+from evaluate_best_player import evaluate_best_player
+from league import League, update_league
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import defaultdict
+from pathlib import Path
+import time
+import os
+
+# パラメータ
+CR_CYCLES = 10          # 学習サイクル数
+CR_BACKEND = 'keras'    # 常駐するモデルでの探索の推論の方法('keras'、'numpy':学習のたびに重みを畳み込み直す)
+CR_LEAGUE = True        # 昇格したモデルをリーグに追加するか(リーグはチェックポイントのファイルを使う)
+
+# 常駐モードでは使われない設定のうち、既定から変更されているもの -> 値
+# 自己対戦と評価は常駐している推論器でプロセス内で実行するので、分散・並列実行や推論の方法の設定は効かない
+def ignored_settings():
+    import self_play, evaluate_network, evaluate_best_player
+    settings = {}
+    for module, prefix in ((self_play, 'SP'), (evaluate_network, 'EN'), (evaluate_best_player, 'EP')):
+        values = vars(module)
+        for name, changed in (('RAY_WORKERS', lambda v: v > 0), ('WORKERS', lambda v: v > 1),
+                              ('BACKEND', lambda v: v != 'keras'), ('EVAL_TABLE', bool),
+                              ('INFERENCE_SERVER', lambda v: v is not None)):
+            name = '{}_{}'.format(prefix, name)
+            if name in values and changed(values[name]):
+                settings[name] = values[name]
+    return settings
+
+# 段階ごとの時間(load:モデルの読み込みと重みの受け渡し、save:チェックポイントの書き出し、work:それ以外)
+class StageTimer:
+    def __init__(self):
+        self.seconds = defaultdict(float)  # (段階, 種類) -> 秒
+        self.stages = []                   # 段階の出現順
+
+    @contextmanager
+    def measure(self, stage, kind='work'):
+        if stage not in self.stages:
+            self.stages.append(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage, kind] += time.perf_counter() - start
+
+    # 現時点の累計の時間の複製(reportのsinceに渡すとそれ以降の時間を出力)
+    def snapshot(self):
+        return dict(self.seconds)
+
+    # 段階ごとの時間の出力(background:バックグラウンドのスレッドでの書き出し時間、since:snapshotの結果)
+    def report(self, label, background=0.0, since=None):
+        seconds = defaultdict(float, self.seconds)
+        for key, s in (since or {}).items():
+            seconds[key] -= s
+        total = {kind: sum(s for (_, k), s in seconds.items() if k == kind) for kind in ('work', 'load', 'save')}
+        print('{}: work {:.2f}s, load {:.2f}s, save {:.2f}s (+{:.2f}s in background), load/save {:.1%}'.format(
+            label, total['work'], total['load'], total['save'], background,
+            (total['load'] + total['save']) / max(sum(total.values()), 1e-9)))
+        for stage in self.stages:
+            print('  {}: work {:.2f}s, load {:.2f}s, save {:.2f}s'.format(
+                stage, seconds[stage, 'work'], seconds[stage, 'load'], seconds[stage, 'save']))
+
+# チェックポイントの非同期の書き出し(呼び出し時点の重みを複製し、書き出し用のモデルで保存)
+class CheckpointWriter:
+    def __init__(self, config):
+        self.config = config
+        self.model = build_model(config)  # 学習中のモデルとは別のモデルに重みを移して保存する
+        self.executor = ThreadPoolExecutor(1)
+        self.futures = []
+        self.seconds = 0.0
+
+    def save(self, model, path):
+        self.futures.append(self.executor.submit(self.write, model.get_weights(), path))
+
+    # 書き出し(途中のファイルを読まれないように一時ファイルから置き換える)
+    def write(self, weights, path):
+        start = time.perf_counter()
+        self.model.set_weights(weights)
+        tmp_path = str(Path(path).with_suffix('.tmp.h5'))
+        self.model.save(tmp_path)
+        os.replace(tmp_path, path)
+        save_config(path, self.config)
+        self.seconds += time.perf_counter() - start
+
+    # 書き出し待ち
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures.clear()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+# 常駐しているモデルの推論器
+def resident_predictor(model, backend=CR_BACKEND):
+    if backend == 'numpy':
+        return NumpyPredictor(NumpyNetwork(fold_weights(model)))
+    return Predictor(model)
+
+# モデルの重みを更新した後の推論器の更新
+def refresh_predictor(predictor, model):
+    if isinstance(predictor, NumpyPredictor):
+        predictor.call = NumpyNetwork(fold_weights(model))
+    predictor.weights_changed()
+
+class CycleRunner:
+    def __init__(self, model_path='./model/best.h5', backend=CR_BACKEND):
+        from tensorflow.keras.models import load_model
+        self.model_path = model_path
+        self.timer = StageTimer()
+        settings = ignored_settings()
+        if settings:
+            print('Warning: resident cycles ignore {} (CR_BACKEND={!r}, in-process matches)'.format(
+                ', '.join('{}={!r}'.format(name, value) for name, value in settings.items()), backend))
+
+        # ベストと候補のモデルの読み込み(このプロセスで1回だけ)
+        with self.timer.measure('init', 'load'):
+            dual_network()
+            self.config = load_config(model_path)
+            self.best = load_model(model_path, compile=False)
+            self.candidate = build_model(self.config)
+            self.predictors = {id(model): resident_predictor(model, backend) for model in (self.best, self.candidate)}
+            self.writer = CheckpointWriter(self.config)
+        with self.timer.measure('init'):
+            if CR_LEAGUE and not League().checkpoints:
+                update_league(model_path)
+
+    def predictor(self, model):
+        return self.predictors[id(model)]
+
+    # 1サイクルの実行 -> 昇格したか
+    def run_cycle(self):
+        timer = self.timer
+
+        # 自己対戦(常駐しているベストプレイヤー)
+        with timer.measure('self_play'):
+            self_play(self.predictor(self.best))
+
+        # 学習(ベストの重みを候補にメモリ上で複製して学習)
+        with timer.measure('train', 'load'):
+            self.candidate.set_weights(self.best.get_weights())
+        with timer.measure('train'):
+            train_network(self.candidate)
+        with timer.measure('train', 'load'):
+            refresh_predictor(self.predictor(self.candidate), self.candidate)
+        with timer.measure('train', 'save'):
+            self.writer.save(self.candidate, './model/latest.h5')
+
+        # 評価(プロセス内で対戦)
+        with timer.measure('evaluate'):
+            promoted = evaluate_network(self.predictor(self.candidate), self.predictor(self.best))
+        if not promoted:
+            return False
+
+        # 昇格(参照の入れ替え、元のベストは次のサイクルの候補として再利用)
+        self.best, self.candidate = self.candidate, self.best
+        with timer.measure('evaluate', 'save'):
+            self.writer.save(self.best, self.model_path)
+        print('Changed BestPlayer')
+
+        # ベストプレイヤーの評価
+        with timer.measure('evaluate_best'):
+            evaluate_best_player(self.predictor(self.best))
+
+        # 昇格したモデルをリーグに追加(書き出し済みのチェックポイントを使う)
+        if CR_LEAGUE:
+            with timer.measure('league', 'save'):
+                self.writer.wait()
+            with timer.measure('league'):
+                update_league(self.model_path)
+        return True
+
+    def run(self, cycles=CR_CYCLES):
+        for i in range(cycles):
+            print('Train', i, '=========================')
+            since, background = self.timer.snapshot(), self.writer.seconds
+            self.run_cycle()
+            self.timer.report('Cycle {}'.format(i), self.writer.seconds - background, since)
+        self.close()
+
+    def close(self):
+        with self.timer.measure('close', 'save'):
+            self.writer.close()
+
+# 動作確認
+if __name__ == '__main__':
+    runner = CycleRunner()
+    runner.run()
+    runner.timer.report('Total', runner.writer.seconds)
@@ -0,0 +1,66 @@
+# 学習データの重複局面の集約(同じ局面は方策と価値を平均して1件にまとめ、件数を重みにする)
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
+from game import PIECES_TABLE, SYMMETRIES, SYMMETRY_TABLES
+import numpy as np
+
+# パラメータ
+DD_SYMMETRY = True  # 対称変換で一致する局面も同じ局面として扱うか
+
+# マスごとのビット(盤面 -> ビットボード)
+SQUARE_BITS = 1 << np.arange(DN_OUTPUT_SIZE, dtype=np.int64)
+
+# ビットボード -> 1チャンネル分(9マス)の盤面
+PIECES_ARRAY = np.array(PIECES_TABLE, dtype=np.int8)
+
+# 対称変換ごとのビットボードの変換表(8, 512)と方策の並べ替え(8, 9)
+SYMMETRY_BITS = np.array(SYMMETRY_TABLES, dtype=np.int64)
+SYMMETRY_INDEX = np.array(SYMMETRIES)
+
+# 盤面(n, a, b, c) -> 自分と相手のビットボード
+def board_bits(xs):
+    squares = np.asarray(xs).reshape(len(xs), DN_OUTPUT_SIZE, 2).astype(np.int64)
+    return squares[:, :, 0] @ SQUARE_BITS, squares[:, :, 1] @ SQUARE_BITS
+
+# ビットボード -> 盤面(n, a, b, c)
+def bits_board(bits, enemy_bits):
+    squares = np.stack([PIECES_ARRAY[bits], PIECES_ARRAY[enemy_bits]], axis=2)
+    return squares.reshape(len(bits), *DN_INPUT_SHAPE)
+
+# 重複局面の集約 -> 入力、平均の方策、平均の価値、件数
+def deduplicate(xs, y_policies, y_values, symmetry=DD_SYMMETRY):
+    bits, enemy_bits = board_bits(xs)
+    policies = np.asarray(y_policies, dtype=np.float32)
+    if symmetry:
+        # 対称変換のうちキーが最小になる向きに揃える(方策も同じ向きに並べ替える)
+        keys = SYMMETRY_BITS[:, bits] << 9 | SYMMETRY_BITS[:, enemy_bits]  # (8, n)
+        k = keys.argmin(axis=0)
+        rows = np.arange(len(k))
+        bits, enemy_bits = SYMMETRY_BITS[k, bits], SYMMETRY_BITS[k, enemy_bits]
+        policies = policies[rows[:, None], SYMMETRY_INDEX[k]]
+    keys = bits << 9 | enemy_bits
+
+    # 同じキーの局面ごとに平均
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    sum_policies = np.zeros((len(unique_keys), DN_OUTPUT_SIZE), dtype=np.float64)
+    np.add.at(sum_policies, inverse, policies)
+    sum_values = np.bincount(inverse, weights=np.asarray(y_values, dtype=np.float64), minlength=len(unique_keys))
+    xs = bits_board(unique_keys >> 9, unique_keys & 0x1ff)
+    return (xs, (sum_policies / counts[:, None]).astype(np.float32),
+            (sum_values / counts).astype(np.float32), counts.astype(np.float32))
+
+# 圧縮率の出力
+def report_compression(label, before, after):
+    print('{}: {} -> {} positions, compression x{:.2f}'.format(label, before, after, before / after if after else 0.0))
+
+# 動作確認(世代ごとの圧縮率)
+if __name__ == '__main__':
+    from replay_buffer import ReplayBuffer
+    from shard import load_arrays
+    buffer = ReplayBuffer().refresh()
+    for name, _ in buffer.window:
+        xs, y_policies, y_values = load_arrays(buffer.data_dir / name)
+        for symmetry in (False, True):
+            unique = deduplicate(xs, y_policies, y_values, symmetry)
+            report_compression('{} (symmetry {})'.format(name, symmetry), len(xs), len(unique[0]))
+    xs, y_policies, y_values = buffer.arrays()
+    report_compression('All generations', len(xs), len(deduplicate(xs, y_policies, y_values)[0]))
@@ -1,50 +1,96 @@
-from tensorflow.keras.layers import Activation, Add, BatchNormalization, Conv2D, Dense, GlobalAveragePooling2D, Input
-from tensorflow.keras.models import Model
-from tensorflow.keras.regularizers import l2
-from tensorflow.keras import backend as K
+# TensorFlowはモデルの作成時にだけ読み込む(定数だけを使うNumPyの推論などはTensorFlow無しで動かす)
+from pathlib import Path
+from shutil import copy
+import json
+import sys
 import os
 
+# アーキテクチャのプリセット(3x3の盤面には既定の16ブロック*128チャンネルは大きすぎるので小さい構成も選べる)
+DN_PRESETS = {
+    'tiny': {'filters': 32, 'residual_num': 2},
+    'small': {'filters': 64, 'residual_num': 4},
+    'default': {'filters': 128, 'residual_num': 16},
+}
+
+# プリセット名の確認(不明な名前は選べるプリセットを示してエラー)
+def check_preset(preset):
+    if preset not in DN_PRESETS:
+        raise ValueError('unknown preset {!r}, expected one of: {}'.format(preset, ', '.join(DN_PRESETS)))
+    return preset
+
 # パラメータの準備
-DN_FILTERS = 128            # 畳み込み層のカーネル数
-DN_RESIDUAL_NUM = 16        # 残差ブロックの数
+DN_PRESET = check_preset(os.environ.get('DN_PRESET', 'default'))  # 新しく作成するモデルのプリセット(環境変数DN_PRESETで指定)
+DN_FILTERS = DN_PRESETS[DN_PRESET]['filters']            # 畳み込み層のカーネル数
+DN_RESIDUAL_NUM = DN_PRESETS[DN_PRESET]['residual_num']  # 残差ブロックの数
 DN_INPUT_SHAPE = (3, 3, 2)  # 入力の形状
 DN_OUTPUT_SIZE = 9         # 行動数(配置先(3*3))
 
+# プリセットの構成
+def preset_config(preset=DN_PRESET):
+    return dict(DN_PRESETS[check_preset(preset)], preset=preset)
+
+# モデルファイルに対応する構成ファイルのパス(best.h5 -> best.json)
+def config_path(model_path):
+    return str(Path(model_path).with_suffix('.json'))
+
+# モデルの構成の保存
+def save_config(model_path, config):
+    with open(config_path(model_path), 'w') as f:
+        json.dump(config, f)
+
+# モデルの構成の読み込み(構成ファイルが無い以前のモデルは既定の構成)
+def load_config(model_path):
+    path = config_path(model_path)
+    if not os.path.exists(path):
+        return preset_config('default')
+    with open(path) as f:
+        return json.load(f)
+
+# モデルファイルと構成ファイルのコピー
+def copy_model(src, dst):
+    copy(src, dst)
+    if os.path.exists(config_path(src)):
+        copy(config_path(src), config_path(dst))
+
 # 畳み込み層の定義
 def conv(filters):
+    from tensorflow.keras.layers import Conv2D
+    from tensorflow.keras.regularizers import l2
     return Conv2D(filters, 3, padding='same', use_bias=False, kernel_initializer='he_normal', kernel_regularizer=l2(0.0005))
 
 # 残差ブロックの定義
-def residual_block():
+def residual_block(filters=DN_FILTERS):
+    from tensorflow.keras.layers import Activation, Add, BatchNormalization
+
     def f(x):
         sc = x                      # スキップ接続のための入力を保存
-        x = conv(DN_FILTERS)(x)     # 畳み込み層
+        x = conv(filters)(x)        # 畳み込み層
         x = BatchNormalization()(x) # 正規化
         x = Activation('relu')(x)   # 活性化関数
-        x = conv(DN_FILTERS)(x)     # 畳み込み層
+        x = conv(filters)(x)        # 畳み込み層
         x = BatchNormalization()(x) # 正規化
         x = Add()([x, sc])          # スキップ接続
         x = Activation('relu')(x)   # 活性化関数
         return x
     return f
 
-# デュアルネットワークのモデルを定義
-def dual_network():
-    # モデル作成済みの場合は無処理
-    if os.path.exists('./model/best.h5'):
-        return
+# 構成に従ったデュアルネットワークのモデルの構築
+def build_model(config):
+    from tensorflow.keras.layers import Activation, BatchNormalization, Dense, GlobalAveragePooling2D, Input
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.regularizers import l2
 
     # 入力層
     inputs = Input(DN_INPUT_SHAPE)
 
     # 畳み込み層
-    x = conv(DN_FILTERS)(inputs)
+    x = conv(config['filters'])(inputs)
     x = BatchNormalization()(x)
     x = Activation('relu')(x)
 
-    # 残差ブロック*16
-    for _ in range(DN_RESIDUAL_NUM):
-        x = residual_block()(x)
+    # 残差ブロック
+    for _ in range(config['residual_num']):
+        x = residual_block(config['filters'])(x)
 
     # プーリング層
     x = GlobalAveragePooling2D()(x)
@@ -57,17 +103,32 @@ def dual_network():
     v = Activation('tanh', name='v')(v)
 
     # モデルの作成
-    model = Model(inputs=inputs, outputs=[p, v])
+    return Model(inputs=inputs, outputs=[p, v])
+
+# デュアルネットワークのモデルを定義
+def dual_network(preset=DN_PRESET):
+    # モデル作成済みの場合は無処理(既存のモデルの構成を使い続ける)
+    if os.path.exists('./model/best.h5'):
+        existing = load_config('./model/best.h5')['preset']
+        if existing != preset:
+            print('Keeping existing model (preset {}), not creating preset {}'.format(existing, preset))
+        return
+    from tensorflow.keras import backend as K
+
+    # モデルの作成
+    config = preset_config(preset)
+    model = build_model(config)
 
     # モデルの保存
     os.makedirs('./model/', exist_ok=True)  # モデル保存用ディレクトリの作成
     model.save('./model/best.h5')                 # ベストプレイヤーのモデルを保存
+    save_config('./model/best.h5', config)        # 構成をモデルの隣に保存
 
     # モデルの破棄
     K.clear_session()
     del model
 
-# 動作確認
+# 動作確認(引数でプリセットを指定)
 if __name__ == '__main__':
-    dual_network()  # デュアルネットワークのモデルを作成
-    print("Dual network model created and saved.")
\ No newline at end of file
+    dual_network(sys.argv[1] if len(sys.argv) > 1 else DN_PRESET)  # デュアルネットワークのモデルを作成
+    print("Dual network model created and saved.")
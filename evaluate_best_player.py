@@ -1,84 +1,49 @@
-from game import State, random_action, alpha_beta_action, mcts_action
-from pv_mcts import pv_mcts_action
-from tensorflow.keras.models import load_model
+from match import (pv_mcts_player, resident_player, run_matches, report_players, clear_players, print_progress,
+                   MT_WORKERS, RANDOM_PLAYER, TABLEBASE_PLAYER, MCTS_PLAYER)
+from pv_mcts import ROOT_CACHE
 from tensorflow.keras import backend as K
-from pathlib import Path
-import numpy as np
 
 # パラメータ
+# 常駐モード(cycle_runner)では渡された推論器でプロセス内で順番に対戦するので、EP_WORKERS・EP_BACKEND・EP_EVAL_TABLE・
+# EP_INFERENCE_SERVERは使わない(モデルの読み込みを省く代わりに、対戦はプロセスで並列化しない)
 EP_GAME_COUNT = 10 # 1評価あたりのゲーム数
-
-# 先手プレイヤーのポイント
-def first_player_point(ended_state):
-    if ended_state.is_lose():
-        return 0 if ended_state.is_first_player() else 1
-    return 0.5
-
-# 1ゲームの実行
-def play(next_actions):
-    # 状態の生成
-    state = State()
-
-    # ゲーム終了までループ
-    while True:
-        # ゲーム終了時
-        if state.is_done():
-            break
-
-        # 行動の選択
-        next_action = next_actions[0] if state.is_first_player() else next_actions[1]
-        action = next_action(state)
-
-        # 次の状態の取得
-        state = state.next(action)
-
-    # 先手プレイヤーのポイントを返す
-    return first_player_point(state)
-
-# 任意のアルゴリズムの評価
-def evaluate_algorithm_of(label, next_actions):
-    # 複数回の対戦を繰り返す
-    total_point = 0
-    for i in range(EP_GAME_COUNT):
-        # 1ゲームの実行
-        if i % 2 == 0:
-            total_point += play(next_actions)
-        else:
-            total_point += 1 - play(list(reversed(next_actions)))
-
-        # 出力
-        print('\rEvaluate {}/{}'.format(i + 1, EP_GAME_COUNT), end='')
-    print('')
-
-    # 平均ポイントを計算
-    average_point = total_point / EP_GAME_COUNT
-    print(label.format(average_point))
-
-# ベストプレイヤーの評価
-def evaluate_best_player():
-    # ベストプレイヤーのモデルの読み込み
-    model = load_model('./model/best.h5')
-
-    # PV MCTSで行動選択を行う関数の定義
-    next_pv_mcts_actions = pv_mcts_action(model, 0.0)
-
-    # VSランダム
-    next_actions_random = (next_pv_mcts_actions, random_action)
-    evaluate_algorithm_of('VS_Random', next_actions_random)
-
-    # VSアルファベータ法
-    next_actions = (next_pv_mcts_actions, alpha_beta_action)
-    evaluate_algorithm_of('VS_AlphaBeta', next_actions)
-
-    # VSモンテカルロ木探索
-    next_actions = (next_pv_mcts_actions, mcts_action)
-    evaluate_algorithm_of('VS_MCTS', next_actions)
-
-    # モデルの破棄
-    K.clear_session()
-    del model
+EP_EVAL_TABLE = False # 全局面の推論結果を事前に計算してモデルの隣に保存するか
+EP_ROOT_CACHE = 'lazy' # 序盤の探索結果の対局間での共有(None:しない、'lazy':随時登録、'build':読み込み時に構築)
+EP_INFERENCE_SERVER = None # 推論サーバーのアドレス(Noneならプロセス内で推論)
+EP_WORKERS = MT_WORKERS # 対戦を並列に実行するプロセス数(1ならプロセス内で順番に実行)
+EP_BACKEND = 'keras' # プロセス内の推論の方法('keras'、'numpy'、量子化した'float16'・'int8')
+
+# ベストプレイヤーの評価(常駐している推論器を渡すとプロセス内で対戦する)
+def evaluate_best_player(predictor=None):
+    # ベストプレイヤー(PV MCTSで行動選択)
+    if predictor is not None:
+        best = resident_player('best', predictor, 0.0, EP_ROOT_CACHE)
+        workers = 1
+    else:
+        best = pv_mcts_player('./model/best.h5', 0.0, EP_INFERENCE_SERVER, EP_EVAL_TABLE, EP_ROOT_CACHE, EP_BACKEND)
+        workers = EP_WORKERS
+
+    # VSランダム、VSアルファベータ法(完全解析テーブルで同じ最善手を即座に選択)、VSモンテカルロ木探索
+    pairings = {
+        'VS_Random': (best, RANDOM_PLAYER),
+        'VS_AlphaBeta': (best, TABLEBASE_PLAYER),
+        'VS_MCTS': (best, MCTS_PLAYER),
+    }
+    average_points = run_matches(pairings, EP_GAME_COUNT, workers, print_progress)
+    for label, average_point in average_points.items():
+        print('{}: {:.3f}'.format(label, average_point))
+
+    # プロセス内で対戦した場合は探索の統計を出力
+    if workers <= 1:
+        report_players()
+        ROOT_CACHE.report()
+
+    # モデルの破棄(常駐しているモデルはそのまま)
+    clear_players()
+    if predictor is None:
+        K.clear_session()
 
 # 動作確認
 if __name__ == "__main__":
     # ベストプレイヤーの評価
-    evaluate_best_player()
\ No newline at end of file
+    evaluate_best_player()
@@ -1,87 +1,65 @@
-from game import State
-from pv_mcts import pv_mcts_action
-from tensorflow.keras.models import load_model
+from match import (pv_mcts_player, resident_player, run_matches, report_players, clear_players, print_progress,
+                   MT_WORKERS)
+from gating import sprt_gate
+from inference import EVAL_CACHE
+from pv_mcts import ROOT_CACHE
 from tensorflow.keras import backend as K
-from pathlib import Path
-from shutil import copy
-import numpy as np
-
-from test1 import next_actions
+from dual_network import copy_model
 
 # パラメータ
+# 常駐モード(cycle_runner)では渡された推論器でプロセス内で順番に対戦するので、EN_WORKERS・EN_BACKEND・EN_EVAL_TABLE・
+# EN_INFERENCE_SERVERは使わない(モデルの読み込みと書き出しを省く代わりに、対戦はプロセスで並列化しない)
 EN_GAME_COUNT = 10  # 1評価あたりのゲーム数
 EN_TEMPERATURE = 1.0  # 温度パラメータ
-
-# 先手プレイヤーのポイント
-def first_player_point(ended_state):
-    # 1:先手勝利、0:後手勝利、0.5:引き分け
-    if ended_state.is_lose():
-        return 0 if ended_state.is_first_player() else 1
-    return 0.5
-
-# 1ゲームの実行
-def play(model):
-    # 状態の生成
-    state = State()
-
-    # ゲーム終了までループ
-    while True:
-        # ゲーム終了時
-        if state.is_done():
-            break
-
-        # 行動の取得
-        next_action = next_actions[0] if state.is_first_player() else next_actions[1]
-        action = next_action(state)
-
-        # 次の状態の取得
-        state = state.next(action)
-
-    # 先手プレイヤーのポイントを返す
-    return first_player_point(state)
+EN_EVAL_TABLE = False # 全局面の推論結果を事前に計算してモデルの隣に保存するか
+EN_ROOT_CACHE = 'lazy' # 序盤の探索結果の対局間での共有(None:しない、'lazy':随時登録、'build':読み込み時に構築)
+EN_INFERENCE_SERVER = None # ベストプレイヤーの推論サーバーのアドレス(Noneならプロセス内で推論)
+EN_WORKERS = MT_WORKERS # 対戦を並列に実行するプロセス数(1ならプロセス内で順番に実行)
+EN_GATING = 'sprt' # 昇格の判定方法('fixed':EN_GAME_COUNTゲームの平均ポイント、'sprt':逐次確率比検定で打ち切り)
+EN_BACKEND = 'keras' # プロセス内の推論の方法('keras'、'numpy'、量子化した'float16'・'int8')
 
 # ベストプレイヤーの交代
 def update_best_player():
-    copy('./model/latest.h5', './model/best.h5')
+    copy_model('./model/latest.h5', './model/best.h5')
     print('Changed BestPlayer')
 
 # ネットワークの評価
-def evaluate_network():
-    # 最新プレイヤーのモデルの読み込み
-    model0 = load_model('./model/latest.h5')
-
-    # ベストプレイヤーのモデルの読み込み
-    model1 = load_model('./model/best.h5')
-
-    # PV MCTSで行動選択を行う関数の定義
-    next_action0 = pv_mcts_action(model0, EN_TEMPERATURE)
-    next_action1 = pv_mcts_action(model1, EN_TEMPERATURE)
-    next_actions = (next_action0, next_action1)
-
-    # 複数回の対戦を繰り返す
-    total_point = 0
-    for i in range(EN_GAME_COUNT):
-        # 1ゲームの実行
-        if i % 2 == 0:
-            total_point += play(next_actions)
-        else:
-            total_point += 1 - play(list(reversed(next_actions)))
-
-        # 出力
-        print('\rEvaluate {}/{}'.format(i + 1, EN_GAME_COUNT), end='')
-    print('')
-
-    # 平均ポイントを計算
-    average_point = total_point / EN_GAME_COUNT
-    print('Average Point: {:.3f}'.format(average_point))
-
-    # モデルの破棄
+# 常駐している最新プレイヤーとベストプレイヤーの推論器を渡すと、プロセス内で対戦して判定だけを返す(モデルは交代しない)
+def evaluate_network(latest_predictor=None, best_predictor=None):
+    # 最新プレイヤーとベストプレイヤー(PV MCTSで行動選択)
+    resident = latest_predictor is not None
+    if resident:
+        latest = resident_player('latest', latest_predictor, EN_TEMPERATURE, EN_ROOT_CACHE)
+        best = resident_player('best', best_predictor, EN_TEMPERATURE, EN_ROOT_CACHE)
+        workers = 1
+    else:
+        latest = pv_mcts_player('./model/latest.h5', EN_TEMPERATURE, None, EN_EVAL_TABLE, EN_ROOT_CACHE, EN_BACKEND)
+        best = pv_mcts_player('./model/best.h5', EN_TEMPERATURE, EN_INFERENCE_SERVER, EN_EVAL_TABLE, EN_ROOT_CACHE,
+                              EN_BACKEND)
+        workers = EN_WORKERS
+
+    # 先後を入れ替えながら複数回の対戦を実行
+    if EN_GATING == 'sprt':
+        update = sprt_gate(latest, best, workers, fixed_games=EN_GAME_COUNT)
+    else:
+        average_point = run_matches({'latest': (latest, best)}, EN_GAME_COUNT, workers, print_progress)['latest']
+        print('Average Point: {:.3f}'.format(average_point))
+        update = average_point > 0.5  # 平均ポイントが0.5を超えた場合、最新モデルをベストプレイヤーに更新
+
+    # プロセス内で対戦した場合は探索の統計を出力
+    if workers <= 1:
+        EVAL_CACHE.report()
+        report_players({latest: 'Latest', best: 'Best'})
+        ROOT_CACHE.report()
+
+    # モデルの破棄(常駐しているモデルはそのまま)
+    clear_players()
+    if resident:
+        return update
     K.clear_session()
-    del model0
-    del model1
 
     # ベストプレイヤーの更新
-    if average_point > 0.5:  # 平均ポイントが0.5を超えた場合、最新モデルをベストプレイヤーに更新
+    if update:
         update_best_player()
         return True
     else:
@@ -1,7 +1,8 @@
 import random
 import math
 
-class State:
+# リスト版の状態(ベンチマーク・検証用)
+class ListState:
     def __init__(self, pieces = None, enemy_pieces = None):
         self.pieces = pieces if pieces is not None else [0] * 9
         self.enemy_pieces = enemy_pieces if enemy_pieces is not None else [0] * 9
@@ -44,7 +45,7 @@ class State:
     def next(self, action):
         pieces = self.pieces.copy()
         pieces[action] = 1
-        return State(self.enemy_pieces, pieces)
+        return ListState(self.enemy_pieces, pieces)
 
     # 合法手のリストの取得
     def legal_actions(self):
@@ -73,6 +74,155 @@ class State:
                 str += '\n'
         return str
 
+# ビットボードの定数
+LINE_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # 横
+    0b001001001, 0b010010010, 0b100100100,  # 縦
+    0b100010001, 0b001010100,               # 斜め
+)
+FULL_MASK = 0b111111111
+
+# 3並びを含むかどうか(ビットボード -> bool)
+LOSE_TABLE = tuple(any(b & m == m for m in LINE_MASKS) for b in range(FULL_MASK + 1))
+
+# 空きマスのビットボード -> 合法手のタプル
+LEGAL_ACTIONS_TABLE = tuple(tuple(i for i in range(9) if b >> i & 1) for b in range(FULL_MASK + 1))
+
+# ビットボード -> 9要素のリスト表現
+PIECES_TABLE = tuple(tuple(b >> i & 1 for i in range(9)) for b in range(FULL_MASK + 1))
+
+# リスト表現 -> ビットボード
+def to_bits(pieces):
+    bits = 0
+    for i, p in enumerate(pieces):
+        if p:
+            bits |= 1 << i
+    return bits
+
+# ビットボード版の状態
+class BitState:
+    __slots__ = ('bits', 'enemy_bits', 'count')
+
+    def __init__(self, pieces=None, enemy_pieces=None):
+        self.bits = to_bits(pieces) if pieces is not None else 0
+        self.enemy_bits = to_bits(enemy_pieces) if enemy_pieces is not None else 0
+        self.count = bin(self.bits | self.enemy_bits).count('1')  # 石の数
+
+    # ビットボードから直接生成
+    @classmethod
+    def from_bits(cls, bits, enemy_bits, count):
+        state = cls.__new__(cls)
+        state.bits = bits
+        state.enemy_bits = enemy_bits
+        state.count = count
+        return state
+
+    # 自分の石(9要素のリスト)
+    @property
+    def pieces(self):
+        return list(PIECES_TABLE[self.bits])
+
+    # 相手の石(9要素のリスト)
+    @property
+    def enemy_pieces(self):
+        return list(PIECES_TABLE[self.enemy_bits])
+
+    def piece_count(self, pieces):
+        return sum(pieces)
+
+    # 負けかどうか
+    def is_lose(self):
+        return LOSE_TABLE[self.enemy_bits]
+
+    # 引き分けかどうか
+    def is_draw(self):
+        return self.count == 9
+
+    # ゲーム終了かどうか
+    def is_done(self):
+        return self.count == 9 or LOSE_TABLE[self.enemy_bits]
+
+    # 次の状態の取得
+    def next(self, action):
+        return BitState.from_bits(self.enemy_bits, self.bits | 1 << action, self.count + 1)
+
+    # 合法手のリストの取得
+    def legal_actions(self):
+        return LEGAL_ACTIONS_TABLE[~(self.bits | self.enemy_bits) & FULL_MASK]
+
+    # 先手かどうか
+    def is_first_player(self):
+        return self.count % 2 == 0
+
+    # 文字列表示
+    def __str__(self):
+        ox = ('o', 'x') if self.is_first_player() else ('x', 'o')
+        str = ''
+        for i in range(9):
+            if self.bits >> i & 1:
+                str += ox[0]
+            elif self.enemy_bits >> i & 1:
+                str += ox[1]
+            else:
+                str += '-'
+            if i % 3 == 2:
+                str += '\n'
+        return str
+
+# 既定の状態クラス
+State = BitState
+
+# 盤面の8通りの対称変換(変換後のマスiには変換前のマスSYMMETRIES[k][i]が入る)
+def _symmetries():
+    perms = []
+    for flip in (False, True):
+        for rot in range(4):
+            perm = []
+            for i in range(9):
+                y, x = divmod(i, 3)
+                for _ in range(rot):  # 90度回転
+                    y, x = x, 2 - y
+                if flip:  # 左右反転
+                    x = 2 - x
+                perm.append(y * 3 + x)
+            perms.append(tuple(perm))
+    return tuple(perms)
+SYMMETRIES = _symmetries()
+
+# 逆変換(変換前のマスaは変換後のマスINVERSE_SYMMETRIES[k][a]に移る)
+INVERSE_SYMMETRIES = tuple(tuple(perm.index(a) for a in range(9)) for perm in SYMMETRIES)
+
+# 対称変換ごとのビットボードの変換表
+SYMMETRY_TABLES = tuple(
+    tuple(to_bits(PIECES_TABLE[b][perm[i]] for i in range(9)) for b in range(FULL_MASK + 1))
+    for perm in SYMMETRIES)
+
+# 対称変換を同一視した局面のキーと、そのキーを与える対称変換の番号
+def canonical_key(state):
+    best_key, best_k = -1, 0
+    for k, table in enumerate(SYMMETRY_TABLES):
+        key = table[state.bits] << 9 | table[state.enemy_bits]
+        if best_key < 0 or key < best_key:
+            best_key, best_k = key, k
+    return best_key, best_k
+
+# 到達可能な全局面(正規化した局面のキー -> 正規化した向きの状態)
+def canonical_states(include_done=False):
+    states = {}
+    stack = [State()]
+    while stack:
+        state = stack.pop()
+        key, k = canonical_key(state)
+        if key in states:
+            continue
+        table = SYMMETRY_TABLES[k]
+        states[key] = BitState.from_bits(table[state.bits], table[state.enemy_bits], state.count)
+        if not state.is_done():
+            stack.extend(state.next(action) for action in state.legal_actions())
+    if not include_done:
+        states = {key: state for key, state in states.items() if not state.is_done()}
+    return states
+
 # ランダムで行動選択
 def random_action(state):
     legal_actions = state.legal_actions()
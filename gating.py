@@ -0,0 +1,124 @@
+# 逐次確率比検定(SPRT)による最新プレイヤーの昇格の判定
+# 少数のゲームごとに対数尤度比を更新し、「最新プレイヤーの方が強い」を採択か棄却できた時点で打ち切る
+# 引き分けが多いので、勝ち・引き分け・負けの割合から求めた分散で対数尤度比を近似する(GSPRT)
+from match import MatchRunner, MT_WORKERS, print_progress
+from datetime import datetime
+import json
+import math
+import time
+import os
+
+# パラメータ
+GT_ELO0 = 0.0              # 帰無仮説のレーティング差(最新プレイヤーの方が強くない)
+GT_ELO1 = 100.0            # 対立仮説のレーティング差(最新プレイヤーの方が強い、引き分けが多いので50では勝ち負けが拮抗すると100ゲーム以上かかる)
+GT_ALPHA = 0.05            # 第1種の誤り(強くないのに昇格する)の確率
+GT_BETA = 0.05             # 第2種の誤り(強いのに昇格しない)の確率
+GT_BATCH_GAMES = None      # 1回に実行するゲーム数(Noneならプロセス数以上の偶数、先後が揃うように偶数)
+GT_MAX_GAMES = 24          # ゲーム数の上限(達したら平均ポイントで判定)
+GT_PRIOR = 0.5             # 勝ち・引き分け・負けそれぞれに加える仮想のゲーム数(序盤の極端な推定を抑える)
+GT_LOG_PATH = './data/gating_log.jsonl'  # 判定ごとのゲーム数の記録
+
+# レーティング差 -> 期待ポイント
+def elo_to_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+class SPRT:
+    def __init__(self, elo0=GT_ELO0, elo1=GT_ELO1, alpha=GT_ALPHA, beta=GT_BETA):
+        self.s0 = elo_to_score(elo0)
+        self.s1 = elo_to_score(elo1)
+        self.lower = math.log(beta / (1 - alpha))  # これ以下なら棄却
+        self.upper = math.log((1 - beta) / alpha)  # これ以上なら採択
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+    # 1ゲームの結果(1:勝ち、0.5:引き分け、0:負け)の追加
+    def add(self, point):
+        if point == 1:
+            self.wins += 1
+        elif point == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    # 平均ポイント
+    def score(self):
+        return (self.wins + 0.5 * self.draws) / self.games if self.games else 0.5
+
+    # 対数尤度比(正規近似、平均と分散は仮想のゲームを加えた割合から求める)
+    def llr(self):
+        n = self.games
+        if n == 0:
+            return 0.0
+        wins, draws, losses = self.wins + GT_PRIOR, self.draws + GT_PRIOR, self.losses + GT_PRIOR
+        total = wins + draws + losses
+        m = (wins + 0.5 * draws) / total
+        variance = (wins * (1 - m) ** 2 + draws * (0.5 - m) ** 2 + losses * m ** 2) / total
+        return n * (self.s1 - self.s0) * (2 * m - self.s0 - self.s1) / (2 * variance)
+
+    # 判定(True:採択、False:棄却、None:継続)
+    def status(self):
+        llr = self.llr()
+        if llr >= self.upper:
+            return True
+        if llr <= self.lower:
+            return False
+        return None
+
+# 判定の記録
+def log_decision(record, path=GT_LOG_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+# 1回に実行するゲーム数(全てのプロセスが埋まる最小の偶数)
+def batch_size(workers):
+    return max(2, workers + workers % 2)
+
+# 最新プレイヤーとベストプレイヤーの対戦による判定 -> 昇格するか
+def sprt_gate(latest, best, workers=MT_WORKERS, max_games=GT_MAX_GAMES, batch_games=GT_BATCH_GAMES,
+              fixed_games=None):
+    workers = min(workers, max_games)  # ゲーム数より多くのプロセスは起動しない
+    if batch_games is None:
+        batch_games = batch_size(workers)
+    test = SPRT()
+    start = time.perf_counter()
+    accepted = None
+    with MatchRunner(workers) as runner:
+        while accepted is None and test.games < max_games:
+            games = range(test.games, min(test.games + batch_games, max_games))
+            for point in runner.play({'latest': (latest, best)}, games)['latest']:
+                test.add(point)
+            accepted = test.status()
+            print_progress(test.games, max_games)
+
+    # 上限に達したら平均ポイントで判定
+    reason = 'sprt'
+    if accepted is None:
+        reason = 'cap'
+        accepted = test.score() > 0.5
+    elapsed = time.perf_counter() - start
+    if test.games < max_games:
+        print('')
+    print('SPRT: {} after {} games (W/D/L {}/{}/{}, score {:.3f}, LLR {:.2f} in [{:.2f}, {:.2f}]), {:.2f}s'.format(
+        ('accepted' if accepted else 'rejected') + (' at cap' if reason == 'cap' else ''), test.games,
+        test.wins, test.draws, test.losses, test.score(), test.llr(), test.lower, test.upper, elapsed))
+    log_decision({
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'accepted': accepted, 'reason': reason, 'games': test.games, 'fixed_games': fixed_games,
+        'wins': test.wins, 'draws': test.draws, 'losses': test.losses,
+        'llr': test.llr(), 'seconds': elapsed,
+    })
+    return accepted
+
+# 動作確認(全て引き分け・全て勝ちの場合に判定までに必要なゲーム数)
+if __name__ == '__main__':
+    for label, point in (('draws', 0.5), ('wins', 1), ('losses', 0)):
+        test = SPRT()
+        while test.status() is None:
+            test.add(point)
+        print('{}: {} after {} games'.format(label, 'accepted' if test.status() else 'rejected', test.games))
@@ -0,0 +1,305 @@
+# 低オーバーヘッドの推論
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
+from game import PIECES_TABLE, FULL_MASK, SYMMETRIES, canonical_key, canonical_states
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import itertools
+import time
+import os
+
+# パラメータ
+IF_MAX_BATCH = 64      # 入力バッファの最大バッチサイズ
+IF_CACHE_SIZE = 10000  # 推論キャッシュの最大エントリ数
+IF_TABLE_BATCH = 256   # 全局面テーブル構築時のバッチサイズ
+
+# ビットボード -> 入力の1チャンネル分(9マス)
+PLANES_TABLE = np.array(PIECES_TABLE, dtype=np.float32)
+
+# 空きマスのビットボード -> 合法手のマスク
+LEGAL_MASK_TABLE = PLANES_TABLE.copy()
+
+# 対称変換ごとのマスの並べ替え(正規化した盤面の方策 = 元の盤面の方策[SYMMETRY_INDEX[k]])
+SYMMETRY_INDEX = np.array(SYMMETRIES)
+
+# 状態を入力データ(a, b, c)に書き込み
+def encode(state, out):
+    planes = out.reshape(DN_OUTPUT_SIZE, 2)
+    planes[:, 0] = PLANES_TABLE[state.bits]
+    planes[:, 1] = PLANES_TABLE[state.enemy_bits]
+
+# 複数の状態を入力データ(n, a, b, c)に書き込み
+def encode_batch(states, out):
+    bits = np.fromiter((s.bits for s in states), dtype=np.int64, count=len(states))
+    enemy_bits = np.fromiter((s.enemy_bits for s in states), dtype=np.int64, count=len(states))
+    planes = out[:len(states)].reshape(len(states), DN_OUTPUT_SIZE, 2)
+    planes[:, :, 0] = PLANES_TABLE[bits]
+    planes[:, :, 1] = PLANES_TABLE[enemy_bits]
+    return bits, enemy_bits
+
+# 方策を合法手に限定して合計1の確率分布に変換(n, 9)
+def mask_policies(policies, bits, enemy_bits):
+    policies = policies * LEGAL_MASK_TABLE[~(bits | enemy_bits) & FULL_MASK]
+    total = policies.sum(axis=1, keepdims=True)
+    return policies / np.where(total > 0, total, 1)
+
+# モデルファイルの識別子(ファイルが差し替えられると変わる)
+def model_identity(path):
+    stat = os.stat(path)
+    return (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+# 対称変換を同一視した推論結果のLRUキャッシュ
+class EvalCache:
+    def __init__(self, capacity=IF_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # (モデルの識別子, 正規化した局面のキー) -> (正規化した盤面の方策, 価値)
+        self.versions = {}            # モデルファイルのパス -> 現在の識別子
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # モデルの登録(同じパスのファイルが差し替えられていれば古いエントリを破棄)
+    def register(self, path, model_id):
+        old_id = self.versions.get(path)
+        if old_id is not None and old_id != model_id:
+            self.invalidate(old_id)
+        self.versions[path] = model_id
+
+    # 指定したモデル(省略時は全て)のエントリの破棄
+    def invalidate(self, model_id=None):
+        if model_id is None:
+            self.entries.clear()
+        else:
+            for key in [key for key in self.entries if key[0] == model_id]:
+                del self.entries[key]
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # 統計の出力
+    def report(self, label='EvalCache'):
+        total = self.hits + self.misses
+        print('{}: size {}, hits {}, misses {}, evictions {}, hit rate {:.3f}'.format(
+            label, len(self.entries), self.hits, self.misses, self.evictions,
+            self.hits / total if total else 0.0))
+
+# 到達可能な全局面の推論結果のテーブル
+class EvalTable:
+    def __init__(self, keys, policies, values):
+        self.index = {key: i for i, key in enumerate(keys.tolist())}
+        self.keys = keys
+        self.policies = policies  # 正規化した盤面の向きの方策(n, 9)
+        self.values = values      # 価値(n,)
+
+    def __len__(self):
+        return len(self.index)
+
+    # 9マス分の方策(問い合わせた盤面の向き)と価値、テーブルに無い局面はNone
+    def lookup(self, state):
+        key, k = canonical_key(state)
+        i = self.index.get(key)
+        if i is None:
+            return None
+        policies = np.empty(DN_OUTPUT_SIZE, dtype=np.float32)
+        policies[SYMMETRY_INDEX[k]] = self.policies[i]
+        return policies, self.values[i]
+
+    # 全局面を大きなバッチでまとめて推論して構築
+    @classmethod
+    def build(cls, predictor, batch_size=IF_TABLE_BATCH):
+        start = time.perf_counter()
+        states = canonical_states()
+        keys = np.array(list(states), dtype=np.uint32)
+        states = list(states.values())
+        x = np.zeros((len(states), *DN_INPUT_SHAPE), dtype=np.float32)
+        bits, enemy_bits = encode_batch(states, x)
+        policies, values = [], []
+        for i in range(0, len(states), batch_size):
+            p, v = predictor.predict_array(x[i:i + batch_size])
+            policies.append(p)
+            values.append(v)
+        policies = mask_policies(np.concatenate(policies), bits, enemy_bits).astype(np.float32)
+        table = cls(keys, policies, np.concatenate(values))
+        print('EvalTable: {} positions, {:.3f}s'.format(len(table), time.perf_counter() - start))
+        return table
+
+    # 保存(モデルファイルの識別子も記録、書き込み途中のファイルを読まれないように一時ファイルから置き換える)
+    def save(self, path, model_id):
+        tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp_path, keys=self.keys, policies=self.policies, values=self.values,
+                 model_mtime=model_id[1], model_size=model_id[2])
+        os.replace(tmp_path, path)
+
+    # 読み込み(モデルファイルが差し替えられていればNone)
+    @classmethod
+    def load(cls, path, model_id):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if int(f['model_mtime']) != model_id[1] or int(f['model_size']) != model_id[2]:
+                return None
+            return cls(f['keys'], f['policies'], f['values'])
+
+# モデルファイルに対応する全局面テーブルのパス(best.h5 -> best.table.npz)
+def eval_table_path(model_path):
+    return str(Path(model_path).with_suffix('.table.npz'))
+
+# プロセス内で共有する推論キャッシュ
+EVAL_CACHE = EvalCache()
+
+# 推論器ごとの識別子
+_predictor_ids = itertools.count()
+
+# モデルごとに1回だけ構築する推論器
+class Predictor:
+    def __init__(self, model, max_batch=IF_MAX_BATCH, jit_compile=False, cache=EVAL_CACHE, model_id=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.buffer = np.zeros((max_batch, *DN_INPUT_SHAPE), dtype=np.float32)  # 再利用する入力バッファ
+        self.cache = cache                                                         # Noneならキャッシュしない
+        self.table = None                                                          # 全局面テーブル(構築後は推論しない)
+        self.model_id = model_id if model_id is not None else (None, next(_predictor_ids))
+        self.call = self.trace(model, jit_compile)
+
+    # 入力シグネチャ固定でトレースした推論関数(TensorFlowはここで初めて読み込む)
+    def trace(self, model, jit_compile):
+        import tensorflow as tf
+        return tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None, *DN_INPUT_SHAPE), tf.float32)],
+            jit_compile=jit_compile)
+
+    # モデルの重みを更新した場合(常駐しているモデルの学習後など)の識別子の更新
+    # 古い識別子のキャッシュのエントリ、序盤の探索結果、全局面テーブルは使わなくなるので破棄
+    def weights_changed(self):
+        from pv_mcts import ROOT_CACHE  # pv_mctsはこのモジュールを読み込むので実行時に読み込む
+        if self.cache is not None:
+            self.cache.invalidate(self.model_id)
+        ROOT_CACHE.invalidate(self.model_id)
+        self.model_id = (None, next(_predictor_ids))
+        self.table = None
+
+    # 入力データ(n, a, b, c)の推論 -> 方策(n, 9)と価値(n,)
+    def predict_array(self, x):
+        p, v = self.call(x)
+        return p.numpy(), v.numpy()[:, 0]
+
+    # 複数局面のネットワークでの推論(キャッシュを使わない)
+    def evaluate_batch(self, states):
+        policies, values = [], []
+        for i in range(0, len(states), self.max_batch):
+            chunk = states[i:i + self.max_batch]
+            bits, enemy_bits = encode_batch(chunk, self.buffer)
+            p, v = self.predict_array(self.buffer[:len(chunk)])
+            policies.append(mask_policies(p, bits, enemy_bits))
+            values.append(v)
+        if not policies:
+            return np.zeros((0, DN_OUTPUT_SIZE), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return np.concatenate(policies), np.concatenate(values)
+
+    # 全局面テーブルの構築(モデルファイルから読み込んだ推論器で保存先を指定すると読み込み・保存する)
+    def build_table(self, path=None):
+        if self.model_id[0] is None:
+            path = None
+        if path is not None:
+            self.table = EvalTable.load(path, self.model_id)
+            if self.table is not None:
+                print('EvalTable: {} positions loaded from {}'.format(len(self.table), path))
+                return self.table
+        self.table = EvalTable.build(self)
+        if path is not None:
+            self.table.save(path, self.model_id)
+        return self.table
+
+    # 1局面の推論(合法手のみの方策と価値)
+    def predict(self, state):
+        legal_actions = list(state.legal_actions())
+        if self.table is not None:
+            entry = self.table.lookup(state)
+            if entry is not None:
+                return entry[0][legal_actions], entry[1]
+        if self.cache is not None:
+            policies, value = self.predict_batch([state])
+            return policies[0][legal_actions], value[0]
+
+        x = self.buffer[:1]
+        encode(state, x[0])
+        p, v = self.predict_array(x)
+
+        # 方策の取得
+        policies = p[0][legal_actions]   # 合法手のみ
+        total = policies.sum()
+        policies /= total if total else 1  # 合計1の確率分布に変換
+        return policies, v[0]
+
+    # 複数局面の推論(9マス分の合法手マスク済み方策と価値)
+    def predict_batch(self, states):
+        if self.table is not None:
+            entries = [self.table.lookup(state) for state in states]
+            if all(entry is not None for entry in entries):
+                return (np.array([e[0] for e in entries]).reshape(len(states), DN_OUTPUT_SIZE),
+                        np.array([e[1] for e in entries], dtype=np.float32))
+        if self.cache is None:
+            return self.evaluate_batch(states)
+
+        # キャッシュの参照(方策は問い合わせた盤面の向きに戻す)
+        policies = np.zeros((len(states), DN_OUTPUT_SIZE), dtype=np.float32)
+        values = np.zeros(len(states), dtype=np.float32)
+        misses = {}  # 正規化した局面のキー -> [(インデックス, 対称変換の番号)](同じ局面は1回だけ推論)
+        for i, state in enumerate(states):
+            key, k = canonical_key(state)
+            if key in misses:
+                misses[key].append((i, k))
+                self.cache.hits += 1
+                continue
+            entry = self.cache.get((self.model_id, key))
+            if entry is None:
+                misses[key] = [(i, k)]
+            else:
+                policies[i, SYMMETRY_INDEX[k]] = entry[0]
+                values[i] = entry[1]
+
+        # キャッシュに無い局面の推論と登録(方策は正規化した盤面の向きで保存)
+        if misses:
+            p, v = self.evaluate_batch([states[queries[0][0]] for queries in misses.values()])
+            for (key, queries), pi, vi in zip(misses.items(), p, v):
+                canonical = pi[SYMMETRY_INDEX[queries[0][1]]]
+                self.cache.put((self.model_id, key), (canonical, vi))
+                for i, k in queries:
+                    policies[i, SYMMETRY_INDEX[k]] = canonical
+                    values[i] = vi
+        return policies, values
+
+# モデルファイルの読み込みと推論器の構築(キャッシュはファイルの差し替えで自動的に無効化)
+# eval_tableがTrueなら全局面テーブルを構築し、save_tableがTrueならモデルの隣に保存する
+def load_predictor(path, cache=EVAL_CACHE, eval_table=False, save_table=False, **kwargs):
+    from tensorflow.keras.models import load_model
+    model_id = model_identity(path)
+    if cache is not None:
+        cache.register(str(Path(path).resolve()), model_id)
+    predictor = Predictor(load_model(path, compile=False), cache=cache, model_id=model_id, **kwargs)
+    if eval_table:
+        predictor.build_table(eval_table_path(path) if save_table else None)
+    return predictor
+
+# Kerasモデルに対応する推論器の取得(モデルごとに1回だけ構築、推論器や推論サーバーのクライアントはそのまま返す)
+def get_predictor(model):
+    if hasattr(model, 'predict_batch'):
+        return model
+    predictor = getattr(model, '_predictor', None)
+    if predictor is None:
+        predictor = Predictor(model)
+        model._predictor = predictor
+    return predictor
@@ -0,0 +1,322 @@
+# 複数の探索プロセスで1つのモデルを共有する推論サーバー
+# クライアントごとの共有メモリに入出力の配列を置き、Unixソケットでは局面数と完了通知だけをやり取りする
+from game import State
+from inference import IF_MAX_BATCH, load_predictor, model_identity, EVAL_CACHE
+from numpy_inference import BACKEND_PRECISIONS, load_numpy_predictor
+from multiprocessing import shared_memory, resource_tracker
+from collections import Counter, deque
+import numpy as np
+import selectors
+import socket
+import struct
+import json
+import time
+import sys
+import os
+
+# パラメータ
+IS_ADDRESS = './model/inference.sock'  # Unixソケットのパス
+IS_MAX_WAIT = 0.002                    # 他のクライアントの要求をまとめるために待つ最大時間(秒)
+IS_MAX_BATCH = 256                     # 1回の推論でまとめる最大局面数
+IS_RELOAD_INTERVAL = 1.0               # モデルファイルの差し替えを確認する間隔(秒)
+IS_LATENCY_SAMPLES = 10000             # レイテンシの統計に使う直近の要求数
+
+# メッセージ(要求は局面数かコマンド、応答はモデルの版)
+MESSAGE = struct.Struct('<i')
+CMD_STATS = -1
+CMD_SHUTDOWN = -2
+
+# 共有メモリのサイズ(ビットボード2つ、方策、価値)
+def slot_size(capacity):
+    return capacity * (4 + 4 + 4 * 9 + 4)
+
+# 共有メモリ上の入出力の配列
+def slot_arrays(buf, capacity):
+    bits = np.ndarray(capacity, dtype=np.int32, buffer=buf, offset=0)
+    enemy_bits = np.ndarray(capacity, dtype=np.int32, buffer=buf, offset=capacity * 4)
+    policies = np.ndarray((capacity, 9), dtype=np.float32, buffer=buf, offset=capacity * 8)
+    values = np.ndarray(capacity, dtype=np.float32, buffer=buf, offset=capacity * 44)
+    return bits, enemy_bits, policies, values
+
+# 指定したバイト数の受信(切断時はNone)
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_message(sock):
+    data = recv_exact(sock, MESSAGE.size)
+    return None if data is None else MESSAGE.unpack(data)[0]
+
+# 推論サーバーのクライアント(Predictorと同じpredict/predict_batchを持つ)
+class InferenceClient:
+    def __init__(self, address=IS_ADDRESS, capacity=IF_MAX_BATCH):
+        self.address = address
+        self.capacity = capacity
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+        # 入出力の共有メモリを作成してサーバーに名前を渡す
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_size(capacity))
+        self.bits, self.enemy_bits, self.policies, self.values = slot_arrays(self.shm.buf, capacity)
+        name = self.shm.name.encode()
+        self.sock.sendall(MESSAGE.pack(capacity) + MESSAGE.pack(len(name)) + name)
+        self.set_version(recv_message(self.sock))
+
+    # モデルの版(差し替えられると序盤の探索結果のキャッシュなどが別のモデルとして扱われる)
+    def set_version(self, version):
+        self.version = version
+        self.model_id = ('server', self.address, version)
+
+    # 複数局面の推論(9マス分の合法手マスク済み方策と価値)
+    def predict_batch(self, states):
+        policies = np.zeros((len(states), 9), dtype=np.float32)
+        values = np.zeros(len(states), dtype=np.float32)
+        for i in range(0, len(states), self.capacity):
+            chunk = states[i:i + self.capacity]
+            n = len(chunk)
+            self.bits[:n] = [s.bits for s in chunk]
+            self.enemy_bits[:n] = [s.enemy_bits for s in chunk]
+            self.sock.sendall(MESSAGE.pack(n))
+            self.set_version(recv_message(self.sock))
+            policies[i:i + n] = self.policies[:n]
+            values[i:i + n] = self.values[:n]
+        return policies, values
+
+    # 1局面の推論(合法手のみの方策と価値)
+    def predict(self, state):
+        policies, values = self.predict_batch([state])
+        return policies[0][list(state.legal_actions())], values[0]
+
+    # サーバーの統計の取得
+    def stats(self):
+        self.sock.sendall(MESSAGE.pack(CMD_STATS))
+        return json.loads(recv_exact(self.sock, recv_message(self.sock)))
+
+    # サーバーの停止
+    def shutdown(self):
+        self.sock.sendall(MESSAGE.pack(CMD_SHUTDOWN))
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.sock.close()
+        self.bits = self.enemy_bits = self.policies = self.values = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __del__(self):
+        self.close()
+
+# サーバー側のクライアントごとの状態
+class Slot:
+    def __init__(self, sock, name, capacity):
+        self.sock = sock
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(self.shm._name, 'shared_memory')  # 破棄はクライアントが行う
+        self.bits, self.enemy_bits, self.policies, self.values = slot_arrays(self.shm.buf, capacity)
+
+    def close(self):
+        self.bits = self.enemy_bits = self.policies = self.values = None
+        self.shm.close()
+        self.sock.close()
+
+# 推論サーバー
+class InferenceServer:
+    def __init__(self, model_path='./model/best.h5', address=IS_ADDRESS,
+                 max_wait=IS_MAX_WAIT, max_batch=IS_MAX_BATCH):
+        self.model_path = model_path
+        self.address = address
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.predictor = None
+        self.model_id = None
+        self.version = 0
+        self.slots = {}       # ソケット -> Slot
+        self.pending = []     # (Slot, 局面数, 受信時刻)
+        self.queued = 0       # 待っている局面数
+        self.running = False
+
+        # 統計
+        self.requests = 0
+        self.positions = 0
+        self.batch_sizes = Counter()                          # 推論の局面数(2の累乗ごと) -> 回数
+        self.queue_depths = deque(maxlen=IS_LATENCY_SAMPLES)  # 推論時に待っていた要求数
+        self.latencies = deque(maxlen=IS_LATENCY_SAMPLES)     # 要求の受信から応答までの時間(秒)
+
+        self.reload()
+
+    # モデルファイルが差し替えられていれば読み込み直す(書き込み途中などで失敗したら次回に再試行)
+    def reload(self):
+        try:
+            model_id = model_identity(self.model_path)
+            if model_id == self.model_id:
+                return False
+            predictor = load_predictor(self.model_path, max_batch=self.max_batch)
+        except (OSError, ValueError) as e:
+            print('InferenceServer: failed to load {} ({})'.format(self.model_path, e))
+            return False
+        self.predictor = predictor
+        self.model_id = model_id
+        self.version += 1
+        print('InferenceServer: loaded {} (version {})'.format(self.model_path, self.version))
+        return True
+
+    # クライアントの接続(共有メモリの名前を受け取って応答する)
+    def accept(self, listener):
+        sock, _ = listener.accept()
+        capacity = recv_message(sock)
+        name = recv_exact(sock, recv_message(sock)).decode()
+        slot = Slot(sock, name, capacity)
+        self.slots[sock] = slot
+        self.selector.register(sock, selectors.EVENT_READ, slot)
+        sock.sendall(MESSAGE.pack(self.version))
+
+    def disconnect(self, slot):
+        self.selector.unregister(slot.sock)
+        del self.slots[slot.sock]
+        self.pending = [p for p in self.pending if p[0] is not slot]
+        self.queued = sum(p[1] for p in self.pending)
+        slot.close()
+
+    # クライアントからの要求の受信
+    def receive(self, slot):
+        n = recv_message(slot.sock)
+        if n is None:
+            self.disconnect(slot)
+        elif n == CMD_STATS:
+            data = json.dumps(self.stats()).encode()
+            slot.sock.sendall(MESSAGE.pack(len(data)) + data)
+        elif n == CMD_SHUTDOWN:
+            self.running = False
+        else:
+            self.pending.append((slot, n, time.perf_counter()))
+            self.queued += n
+
+    # 待っている要求をまとめて推論して応答
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        self.queued = 0
+        states = []
+        for slot, n, _ in pending:
+            for b, e in zip(slot.bits[:n].tolist(), slot.enemy_bits[:n].tolist()):
+                states.append(State.from_bits(b, e, (b | e).bit_count()))
+        policies, values = self.predictor.predict_batch(states)
+
+        # 各クライアントの共有メモリに結果を書き込んで通知
+        i = 0
+        reply = MESSAGE.pack(self.version)
+        for slot, n, _ in pending:
+            slot.policies[:n] = policies[i:i + n]
+            slot.values[:n] = values[i:i + n]
+            slot.sock.sendall(reply)
+            i += n
+
+        now = time.perf_counter()
+        self.latencies.extend(now - received for _, _, received in pending)
+        self.queue_depths.append(len(pending))
+        if states:
+            self.batch_sizes[1 << (len(states).bit_length() - 1)] += 1
+        self.requests += len(pending)
+        self.positions += len(states)
+
+    # 統計
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 99]).tolist() if len(latencies) else [0.0] * 3
+        return {
+            'model_version': self.version,
+            'clients': len(self.slots),
+            'requests': self.requests,
+            'positions': self.positions,
+            'batches': sum(self.batch_sizes.values()),
+            'queue_depth': len(self.pending),
+            'queue_depth_mean': float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+            'queue_depth_max': max(self.queue_depths, default=0),
+            'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'latency_ms': dict(zip(('p50', 'p90', 'p99'), percentiles)),
+            'cache_hits': EVAL_CACHE.hits,
+            'cache_misses': EVAL_CACHE.misses,
+        }
+
+    # 統計の出力
+    def report(self):
+        s = self.stats()
+        print('InferenceServer: {} requests, {} positions, {} batches, queue depth mean {:.2f} max {}'.format(
+            s['requests'], s['positions'], s['batches'], s['queue_depth_mean'], s['queue_depth_max']))
+        print('  batch sizes: {}'.format(', '.join('{}+: {}'.format(k, v) for k, v in s['batch_size_histogram'].items())))
+        print('  latency: p50 {p50:.3f}ms, p90 {p90:.3f}ms, p99 {p99:.3f}ms'.format(**s['latency_ms']))
+
+    # 停止の要求まで要求を処理し続ける
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.address)
+        listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        print('InferenceServer: listening on {}'.format(self.address))
+
+        self.running = True
+        next_reload = time.perf_counter() + IS_RELOAD_INTERVAL
+        try:
+            while self.running:
+                # 最も古い要求の待ち時間が尽きるか、モデルの確認の時刻まで待つ
+                now = time.perf_counter()
+                timeout = next_reload - now
+                if self.pending:
+                    timeout = min(timeout, self.pending[0][2] + self.max_wait - now)
+                for key, _ in self.selector.select(max(timeout, 0)):
+                    if key.data is None:
+                        self.accept(key.fileobj)
+                    else:
+                        self.receive(key.data)
+
+                # 局面数が上限に達するか待ち時間が尽きたら推論
+                now = time.perf_counter()
+                if self.pending and (self.queued >= self.max_batch or
+                                     now >= self.pending[0][2] + self.max_wait or
+                                     len(self.pending) == len(self.slots)):
+                    self.flush()
+
+                # モデルファイルの差し替えの確認(要求の途中では差し替えない)
+                if now >= next_reload and not self.pending:
+                    self.reload()
+                    next_reload = now + IS_RELOAD_INTERVAL
+        finally:
+            for slot in list(self.slots.values()):
+                self.disconnect(slot)
+            self.selector.close()
+            listener.close()
+            os.unlink(self.address)
+            self.report()
+
+# 推論器の準備(サーバーのアドレスの指定があればサーバーに接続し、無ければプロセス内で読み込む)
+# backend: プロセス内の推論の方法('keras'、'numpy':TensorFlow無しのNumPyの順伝播、'float16'・'int8':量子化したNumPyの順伝播)
+def open_predictor(path, server=None, backend='keras', **kwargs):
+    if server is None:
+        if backend in BACKEND_PRECISIONS:
+            return load_numpy_predictor(path, BACKEND_PRECISIONS[backend], **kwargs)
+        return load_predictor(path, **kwargs)
+    return InferenceClient(server)
+
+# 動作確認(引数なし:サーバーの起動、stats:統計の表示、stop:サーバーの停止)
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if command == 'serve':
+        InferenceServer().serve_forever()
+    else:
+        client = InferenceClient()
+        if command == 'stats':
+            print(json.dumps(client.stats(), indent=2))
+        elif command == 'stop':
+            client.shutdown()
+        client.close()
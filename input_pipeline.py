@@ -0,0 +1,104 @@
+# tf.dataによる学習データの入力パイプライン(盤面の対称変換によるデータ拡張)
+from dual_network import DN_INPUT_SHAPE
+from game import SYMMETRIES
+import tensorflow as tf
+import numpy as np
+import time
+
+# パラメータ
+IP_AUGMENT = 'random'        # 対称変換の方法(None:しない、'random':バッチごとにランダム、'exhaustive':8通り全て)
+IP_SHUFFLE_BUFFER = 10000    # シャッフルのバッファの局面数
+IP_BATCH_SIZE = 128          # バッチサイズ
+
+# 対称変換ごとのマスの並べ替え(変換後のマスiには変換前のマスperm[i]の石や方策が入る)
+SYMMETRY_TENSOR = tf.constant(SYMMETRIES, dtype=tf.int32)  # (8, 9)
+SYMMETRY_COUNT = len(SYMMETRIES)
+
+# 盤面(n, a, b, c)と方策(n, 9)にそれぞれの対称変換(n, 9)を適用
+def transform_batch(xs, policies, perms):
+    a, b, c = DN_INPUT_SHAPE
+    squares = tf.reshape(xs, (-1, a * b, c))
+    xs = tf.reshape(tf.gather(squares, perms, batch_dims=1), (-1, a, b, c))
+    policies = tf.gather(policies, perms, batch_dims=1)
+    return xs, policies
+
+# バッチの局面ごとにランダムな対称変換を適用
+def random_transform(xs, policies):
+    k = tf.random.uniform((tf.shape(xs)[0],), maxval=SYMMETRY_COUNT, dtype=tf.int32)
+    return transform_batch(xs, policies, tf.gather(SYMMETRY_TENSOR, k))
+
+# 1局面を8通りの対称変換した局面に展開
+def expand_symmetries(x, policy, value, *weight):
+    n = SYMMETRY_COUNT
+    xs, policies = transform_batch(tf.repeat(x[tf.newaxis], n, axis=0),
+                                   tf.repeat(policy[tf.newaxis], n, axis=0), SYMMETRY_TENSOR)
+    return (xs, policies, tf.repeat(value[tf.newaxis], n), *(tf.repeat(w[tf.newaxis], n) for w in weight))
+
+# 学習データのデータセット(入力、(方策, 価値)[, 重み])の作成
+def make_dataset(xs, y_policies, y_values, sample_weights=None, augment=IP_AUGMENT,
+                 batch_size=IP_BATCH_SIZE, shuffle_buffer=IP_SHUFFLE_BUFFER):
+    columns = (xs, np.asarray(y_policies, dtype=np.float32), np.asarray(y_values, dtype=np.float32))
+    if sample_weights is not None:
+        columns += (np.asarray(sample_weights, dtype=np.float32),)
+    dataset = tf.data.Dataset.from_tensor_slices(columns)
+    if augment == 'exhaustive':
+        dataset = dataset.map(expand_symmetries, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+    elif augment not in (None, 'random'):
+        raise ValueError('unknown augment: {}'.format(augment))
+    dataset = dataset.shuffle(shuffle_buffer).batch(batch_size)
+
+    def prepare(x, policies, values, *weight):
+        x = tf.cast(x, tf.float32)
+        if augment == 'random':
+            x, policies = random_transform(x, policies)
+        return (x, (policies, values), *weight)
+    return dataset.map(prepare, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+# 1エポックあたりの局面数
+def samples_per_epoch(count, augment=IP_AUGMENT):
+    return count * SYMMETRY_COUNT if augment == 'exhaustive' else count
+
+# 学習の速度(局面/秒)の出力(batch_sizeを指定するとエポックの途中で止まってもバッチ数から数える)
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    def __init__(self, samples_per_epoch=None, batch_size=None, label='Train'):
+        super().__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.batch_size = batch_size
+        self.label = label
+
+    def on_train_begin(self, logs=None):
+        self.epochs = 0
+        self.batches = 0
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs += 1
+
+    def on_train_end(self, logs=None):
+        elapsed = time.perf_counter() - self.start
+        if self.batch_size is not None:
+            samples = self.batch_size * self.batches
+        else:
+            samples = self.samples_per_epoch * self.epochs
+        print('{}: {} samples in {:.2f}s, {:.0f} samples/sec'.format(
+            self.label, samples, elapsed, samples / elapsed if elapsed else 0.0))
+
+# 入力パイプラインだけの速度(局面/秒)
+def dataset_throughput(dataset, epochs=1):
+    start = time.perf_counter()
+    samples = 0
+    for _ in range(epochs):
+        for batch in dataset:
+            samples += int(batch[0].shape[0])
+    return samples / (time.perf_counter() - start)
+
+# 動作確認
+if __name__ == '__main__':
+    from replay_buffer import ReplayBuffer
+    xs, y_policies, y_values = ReplayBuffer().refresh().arrays()
+    for augment in (None, 'random', 'exhaustive'):
+        dataset = make_dataset(xs, y_policies, y_values, augment=augment)
+        print('{}: {:.0f} samples/sec (input only)'.format(augment, dataset_throughput(dataset, 5)))
@@ -0,0 +1,155 @@
+# 昇格した全てのモデルのリーグ(対戦結果の表をディスクに保存して、対戦済みの組み合わせは再び対戦しない)
+from match import MatchRunner, MT_WORKERS, pv_mcts_player, print_progress
+from datetime import datetime
+from dual_network import copy_model
+from pathlib import Path
+import random
+import json
+import math
+import os
+
+# パラメータ
+LG_DIR = './model/league/'           # チェックポイントと対戦結果の保存先
+LG_GAMES_PER_PAIRING = 6             # 1つの組み合わせのゲーム数
+LG_RECENT_OPPONENTS = 2              # 対戦する直近のチェックポイント数
+LG_RANDOM_OPPONENTS = 2              # 対戦するそれ以前のチェックポイント数(ランダム)
+LG_TEMPERATURE = 1.0                 # 対戦の温度パラメータ
+LG_PRIOR_DRAWS = 1                   # レーティングの推定で組み合わせごとに加える仮想の引き分け数
+LG_FIT_ITERATIONS = 100              # レーティングの推定の最大反復回数
+
+# レーティング差 -> 期待ポイント
+def expected_score(diff):
+    return 1 / (1 + 10 ** (-diff / 400))
+
+class League:
+    def __init__(self, league_dir=LG_DIR):
+        self.dir = Path(league_dir)
+        self.path = self.dir / 'league.json'
+        self.checkpoints = []  # [{'name', 'created'}](古い順)
+        self.results = {}      # '名前A|名前B' -> [Aの勝ち, 引き分け, Aの負け]
+        self.ratings = {}      # 名前 -> レーティング
+        if self.path.exists():
+            with self.path.open() as f:
+                data = json.load(f)
+            self.checkpoints = data['checkpoints']
+            self.results = data['results']
+            self.ratings = data['ratings']
+
+    def save(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({'checkpoints': self.checkpoints, 'results': self.results, 'ratings': self.ratings}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def model_path(self, name):
+        return str(self.dir / (name + '.h5'))
+
+    # チェックポイントの追加(モデルファイルと構成ファイルをリーグにコピー)
+    def add(self, model_path):
+        name = 'gen{:04d}'.format(len(self.checkpoints))
+        self.dir.mkdir(parents=True, exist_ok=True)
+        copy_model(model_path, self.model_path(name))
+        self.checkpoints.append({'name': name, 'created': datetime.now().isoformat(timespec='seconds')})
+        self.ratings.setdefault(name, self.ratings[self.checkpoints[-2]['name']] if len(self.checkpoints) > 1 else 0.0)
+        self.save()
+        return name
+
+    # 組み合わせの対戦結果(Aから見た勝ち・引き分け・負け)
+    def record(self, a, b):
+        if a < b:
+            return self.results.get(a + '|' + b, [0, 0, 0])
+        w, d, l = self.results.get(b + '|' + a, [0, 0, 0])
+        return [l, d, w]
+
+    def add_record(self, a, b, wins, draws, losses):
+        if a > b:
+            a, b, wins, losses = b, a, losses, wins
+        old = self.results.get(a + '|' + b, [0, 0, 0])
+        self.results[a + '|' + b] = [old[0] + wins, old[1] + draws, old[2] + losses]
+
+    # 対戦相手の選択(直近のチェックポイントとそれ以前からランダムに)
+    def opponents(self, name):
+        names = [c['name'] for c in self.checkpoints if c['name'] != name]
+        recent = names[-LG_RECENT_OPPONENTS:]
+        older = names[:-LG_RECENT_OPPONENTS] if LG_RECENT_OPPONENTS else names
+        return random.sample(older, min(LG_RANDOM_OPPONENTS, len(older))) + recent
+
+    # 未完了の組み合わせの対戦を並列に実行して結果を保存
+    def play(self, name, opponents, workers=MT_WORKERS):
+        pairings = {}
+        games = {}  # ゲーム番号(先後の決定に使う)は対戦済みの数から続ける
+        for opponent in opponents:
+            done = sum(self.record(name, opponent))
+            if done < LG_GAMES_PER_PAIRING:
+                pairings[opponent] = (pv_mcts_player(self.model_path(name), LG_TEMPERATURE),
+                                      pv_mcts_player(self.model_path(opponent), LG_TEMPERATURE))
+                games[opponent] = range(done, LG_GAMES_PER_PAIRING)
+        if not pairings:
+            return 0
+
+        with MatchRunner(workers) as runner:
+            points = runner.play(pairings, games, print_progress)
+        for opponent, p in points.items():
+            self.add_record(name, opponent, p.count(1), p.count(0.5), p.count(0))
+        self.save()
+        return sum(len(p) for p in points.values())
+
+    # 対戦結果の表からレーティングを推定(前回の値から始める座標ごとのニュートン法、最初のチェックポイントを0に固定)
+    def fit_ratings(self):
+        names = [c['name'] for c in self.checkpoints]
+        ratings = {name: self.ratings.get(name, 0.0) for name in names}
+        scale = 400 / math.log(10)
+        for _ in range(LG_FIT_ITERATIONS):
+            change = 0.0
+            for a in names:
+                score = expected = info = 0.0
+                for b in names:
+                    if a == b:
+                        continue
+                    w, d, l = self.record(a, b)
+                    n = w + d + l
+                    if n == 0:
+                        continue
+                    n += LG_PRIOR_DRAWS
+                    e = expected_score(ratings[a] - ratings[b])
+                    score += w + 0.5 * (d + LG_PRIOR_DRAWS)
+                    expected += n * e
+                    info += n * e * (1 - e)
+                if info > 0:
+                    step = scale * (score - expected) / info
+                    ratings[a] += step
+                    change = max(change, abs(step))
+            if change < 0.01:
+                break
+        base = ratings[names[0]] if names else 0.0
+        self.ratings = {name: r - base for name, r in ratings.items()}
+        self.save()
+        return self.ratings
+
+    # 対戦結果とレーティングの出力
+    def report(self, name=None):
+        names = [c['name'] for c in self.checkpoints]
+        for n in names:
+            print('{}: {:+.1f}'.format(n, self.ratings.get(n, 0.0)))
+        if name is not None:
+            for opponent in names:
+                w, d, l = self.record(name, opponent)
+                if w + d + l:
+                    print('  {} vs {}: W/D/L {}/{}/{}'.format(name, opponent, w, d, l))
+
+# 新しいチェックポイントの登録と対戦、レーティングの更新(毎サイクル実行)
+def update_league(model_path='./model/best.h5', workers=MT_WORKERS):
+    league = League()
+    name = league.add(model_path)
+    played = league.play(name, league.opponents(name), workers)
+    league.fit_ratings()
+    print('League: {} played {} games, rating {:+.1f}'.format(name, played, league.ratings[name]))
+    league.report(name)
+    return league
+
+# 動作確認
+if __name__ == '__main__':
+    league = League()
+    league.fit_ratings()
+    league.report()
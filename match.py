@@ -0,0 +1,186 @@
+# 対戦による評価(先後を交互に入れ替えた複数ゲームをプロセスプールで並列に実行)
+from game import State, random_action, mcts_action
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import multiprocessing
+import random
+import os
+
+# パラメータ
+MT_WORKERS = min(os.cpu_count() or 1, 4)  # 対戦を実行するプロセス数(1ならプロセス内で順番に実行、プロセスごとにモデルを読み込むので上限を設ける)
+
+# 先手プレイヤーのポイント
+def first_player_point(ended_state):
+    # 1:先手勝利、0:後手勝利、0.5:引き分け
+    if ended_state.is_lose():
+        return 0 if ended_state.is_first_player() else 1
+    return 0.5
+
+# 1ゲームの実行
+def play(next_actions):
+    # 状態の生成
+    state = State()
+
+    # ゲーム終了までループ
+    while True:
+        # ゲーム終了時
+        if state.is_done():
+            break
+
+        # 行動の選択
+        next_action = next_actions[0] if state.is_first_player() else next_actions[1]
+        action = next_action(state)
+
+        # 次の状態の取得
+        state = state.next(action)
+
+    # 先手プレイヤーのポイントを返す
+    return first_player_point(state)
+
+# プレイヤーの指定(プロセス間で受け渡せるタプル)
+def pv_mcts_player(model_path, temperature=0.0, server=None, eval_table=False, root_cache='lazy', backend='keras'):
+    return ('pv_mcts', model_path, temperature, server, eval_table, root_cache, backend)
+
+# プロセス内に常駐している推論器のプレイヤー(ワーカープロセスには渡せないのでプロセス内で対戦する)
+def resident_player(label, predictor, temperature=0.0, root_cache='lazy'):
+    from pv_mcts import MCTSSearcher, prepare_root_cache
+    spec = ('resident', label, temperature, predictor.model_id)
+    _players[spec] = MCTSSearcher(predictor, temperature, root_cache=prepare_root_cache(predictor, root_cache)).action
+    return spec
+
+RANDOM_PLAYER = ('random',)
+MCTS_PLAYER = ('mcts',)
+ALPHA_BETA_PLAYER = ('alpha_beta',)
+TABLEBASE_PLAYER = ('tablebase',)
+
+# プロセス内で構築済みのプレイヤー(指定 -> 行動選択の関数)
+_players = {}
+
+# プレイヤーの行動選択の関数の取得(モデルの読み込みなどはプロセスごとに1回だけ)
+def get_player(spec):
+    player = _players.get(spec)
+    if player is not None:
+        return player
+    kind = spec[0]
+    if kind == 'pv_mcts':
+        from inference_server import open_predictor
+        from pv_mcts import MCTSSearcher, prepare_root_cache
+        _, model_path, temperature, server, eval_table, root_cache, backend = spec
+        predictor = open_predictor(model_path, server, backend, eval_table=eval_table, save_table=eval_table)
+        player = MCTSSearcher(predictor, temperature, root_cache=prepare_root_cache(predictor, root_cache)).action
+    elif kind == 'resident':
+        raise ValueError('resident players can only play in the process that created them')
+    elif kind == 'tablebase':
+        from tablebase import load_tablebase
+        player = load_tablebase().next_action
+    elif kind == 'alpha_beta':
+        from search import AlphaBetaSearch
+        player = AlphaBetaSearch().action  # 置換表はプロセス内のゲーム間で再利用
+    else:
+        player = {'random': random_action, 'mcts': mcts_action}[kind]
+    _players[spec] = player
+    return player
+
+# 構築済みのPV MCTSとα-β法のプレイヤーの探索の統計の出力
+def report_players(labels=None):
+    for spec, player in _players.items():
+        if spec[0] in ('pv_mcts', 'resident'):
+            player.__self__.report((labels or {}).get(spec, 'MCTSSearcher'))
+        elif spec[0] == 'alpha_beta':
+            player.__self__.report((labels or {}).get(spec, 'AlphaBetaSearch'))
+
+# 構築済みのプレイヤーの破棄
+def clear_players():
+    _players.clear()
+
+# 1ゲームの実行(偶数番目はプレイヤー0が先手、奇数番目は後手)-> プレイヤー0のポイント
+# seedを指定すると乱数をゲームの番号ごとに固定する(同じゲームの組で比較する場合)
+def play_game(players, i, seed=None):
+    next_actions = [get_player(spec) for spec in players]
+    if seed is not None:
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+    if i % 2 == 0:
+        return play(next_actions)
+    return 1 - play(list(reversed(next_actions)))
+
+# ワーカーが共有するファイルの事前準備(プールを起動する前に親プロセスで1回だけ作成し、ワーカーが同時に作成しないようにする)
+def prepare_player(spec):
+    if spec[0] == 'tablebase':
+        from tablebase import load_tablebase
+        load_tablebase()
+    elif spec[0] == 'pv_mcts':
+        from inference_server import open_predictor
+        from numpy_inference import BACKEND_PRECISIONS, prepare_numpy_weights
+        _, model_path, _, server, eval_table, _, backend = spec
+        if server is not None:
+            return
+        if eval_table:
+            open_predictor(model_path, None, backend, cache=None, eval_table=True, save_table=True)  # 重みの準備も含む
+        elif backend in BACKEND_PRECISIONS:
+            prepare_numpy_weights(model_path, BACKEND_PRECISIONS[backend])  # 書き出しと量子化(int8はキャリブレーションも)
+
+# ワーカープロセスの初期化(1プロセスに1コアなので推論のスレッドも1つに制限)
+def init_worker():
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+# 対戦の実行器(ワーカープロセスは閉じるまで使い回すので、モデルの読み込みはプロセスごとに1回だけ)
+class MatchRunner:
+    def __init__(self, workers=MT_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.prepared = set()  # 事前準備が済んだプレイヤーの指定
+        if workers > 1:
+            # TensorFlowはforkと相性が悪いのでspawnでワーカーを起動
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker)
+
+    # 複数の対戦カードのゲームの実行 -> 対戦カードごとのプレイヤー0のポイントのリスト
+    # pairings: 対戦カードのラベル -> (プレイヤー0の指定, プレイヤー1の指定)
+    # games: ゲームの番号(先後の決定に使う)、対戦カードごとに変える場合はラベル -> ゲームの番号
+    def play(self, pairings, games, on_game_end=None, seed=None):
+        tasks = [(label, players, i) for label, players in pairings.items()
+                 for i in (games[label] if isinstance(games, dict) else games)]
+        points = {label: [] for label in pairings}
+
+        def add(label, point):
+            points[label].append(point)
+            if on_game_end is not None:
+                on_game_end(sum(len(p) for p in points.values()), len(tasks))
+
+        if self.executor is None:
+            for label, players, i in tasks:
+                add(label, play_game(players, i, seed))
+        else:
+            for spec in {spec for players in pairings.values() for spec in players} - self.prepared:
+                prepare_player(spec)
+                self.prepared.add(spec)
+            futures = {self.executor.submit(play_game, players, i, seed): label for label, players, i in tasks}
+            for future in as_completed(futures):
+                add(futures[future], future.result())
+        return points
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# 複数の対戦カードの実行 -> 対戦カードごとのプレイヤー0の平均ポイント
+def run_matches(pairings, game_count, workers=MT_WORKERS, on_game_end=None):
+    with MatchRunner(min(workers, game_count * len(pairings))) as runner:  # ゲーム数より多くのプロセスは起動しない
+        points = runner.play(pairings, range(game_count), on_game_end)
+    return {label: sum(p) / game_count for label, p in points.items()}
+
+# 進捗の出力
+def print_progress(done, total):
+    print('\rEvaluate {}/{}'.format(done, total), end='')
+    if done == total:
+        print('')
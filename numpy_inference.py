@@ -0,0 +1,337 @@
+# NumPyだけによる推論(BatchNormalizationを畳み込みに畳み込んだ重みを書き出し、TensorFlow無しで順伝播する)
+# 3x3x2の入力ではTensorFlowの実行時のオーバーヘッドの方が計算そのものよりずっと大きい
+from dual_network import DN_INPUT_SHAPE
+from inference import Predictor, EVAL_CACHE, model_identity
+from pathlib import Path
+import numpy as np
+import os
+
+# 盤面の大きさ
+BOARD_ROWS, BOARD_COLS, INPUT_CHANNELS = DN_INPUT_SHAPE
+SQUARE_COUNT = BOARD_ROWS * BOARD_COLS
+
+# パラメータ
+NI_CALIBRATION_POSITIONS = 4096  # int8のキャリブレーションに使う局面数
+NI_CALIBRATION_PERCENTILE = 100.0  # 量子化の範囲とする入力の分布のパーセンタイル(100なら最大値、下げると外れ値を切り捨てる)
+
+# im2colのインデックス(9, 9): 出力のマスiの3x3カーネルのj番目の位置が参照する入力のマス
+# 盤外(padding='same'のゼロ埋め)は-1
+def im2col_index():
+    index = np.full((SQUARE_COUNT, 9), -1, dtype=np.intp)
+    for i in range(SQUARE_COUNT):
+        r, c = divmod(i, BOARD_COLS)
+        for j in range(9):
+            dr, dc = divmod(j, 3)
+            rr, cc = r + dr - 1, c + dc - 1
+            if 0 <= rr < BOARD_ROWS and 0 <= cc < BOARD_COLS:
+                index[i, j] = rr * BOARD_COLS + cc
+    return index
+
+IM2COL_INDEX = im2col_index()
+
+# バッチ全体のim2colのインデックス(n * 9 * 9,)
+# 特徴マップは(1 + n * 9, チャンネル)の行列で持ち、先頭の行をゼロ埋め用に空けておく(nが小さいバッチは先頭部分を使う)
+def batch_im2col_index(n):
+    index = np.arange(n)[:, None, None] * SQUARE_COUNT + 1 + IM2COL_INDEX
+    return np.where(IM2COL_INDEX < 0, 0, index).ravel()
+
+# モデルファイルに対応する重みファイルのパス(best.h5 -> best.numpy.npz、量子化した重みはbest.int8.npzなど)
+def weights_path(model_path, precision='float32'):
+    return str(Path(model_path).with_suffix('.numpy.npz' if precision == 'float32' else '.{}.npz'.format(precision)))
+
+# BatchNormalizationを直前の畳み込みに畳み込んだ重みとバイアス
+def fold_batch_norm(kernel, bias, batch_norm):
+    gamma, beta, mean, variance = batch_norm.get_weights()
+    scale = gamma / np.sqrt(variance + batch_norm.epsilon)
+    return kernel * scale, (bias - mean) * scale + beta
+
+# Kerasのモデルの重み(畳み込みは(9 * 入力チャンネル, 出力チャンネル)に並べ替える)
+def fold_weights(model):
+    weights = {}
+    convs = 0
+    kernel = bias = None
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == 'Conv2D':
+            kernel = layer.get_weights()[0]
+            bias = layer.get_weights()[1] if layer.use_bias else np.zeros(kernel.shape[-1], dtype=np.float32)
+        elif kind == 'BatchNormalization':
+            kernel, bias = fold_batch_norm(kernel, bias, layer)
+            weights['conv{}_kernel'.format(convs)] = kernel.reshape(-1, kernel.shape[-1])
+            weights['conv{}_bias'.format(convs)] = bias
+            convs += 1
+        elif kind == 'Dense':
+            name = 'pi' if layer.name == 'pi' else 'v'
+            weights[name + '_kernel'], weights[name + '_bias'] = layer.get_weights()
+    weights = {name: np.asarray(w, dtype=np.float32) for name, w in weights.items()}
+    weights['conv_count'] = np.array(convs)
+    return weights
+
+# Kerasのモデルの重みの書き出し
+def export_weights(model, path, model_id=None):
+    weights = fold_weights(model)
+    save_weights(path, weights, model_id)
+    return weights
+
+# 重みファイルの保存(モデルファイルの識別子も記録、書き込み途中のファイルを読まれないように一時ファイルから置き換える)
+def save_weights(path, weights, model_id=None):
+    if model_id is not None:
+        weights = dict(weights, model_mtime=np.array(model_id[1]), model_size=np.array(model_id[2]))
+    tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+    np.savez(tmp_path, **weights)
+    os.replace(tmp_path, path)
+
+# 重みファイルの読み込み(モデルファイルが差し替えられていればNone)
+def load_weights(path, model_id=None):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        if model_id is not None and (
+                'model_mtime' not in f or int(f['model_mtime']) != model_id[1] or int(f['model_size']) != model_id[2]):
+            return None
+        return {name: f[name] for name in f.files}
+
+# NumPyだけのデュアルネットワーク(任意のバッチサイズ、作業用のバッファは最大のバッチサイズに合わせて再利用)
+class NumpyNetwork:
+    def __init__(self, weights):
+        count = int(weights['conv_count'])
+        self.kernels = [weights['conv{}_kernel'.format(i)] for i in range(count)]
+        self.biases = [weights['conv{}_bias'.format(i)] for i in range(count)]
+        self.pi = (weights['pi_kernel'], weights['pi_bias'])
+        self.v = (weights['v_kernel'], weights['v_bias'])
+        self.filters = self.kernels[0].shape[1]
+        self.matmul_kernels = self.kernels  # 行列積に使う重み(量子化する場合は構築時に1回だけfloat32に変換)
+        self.capacity = 0
+
+    # 保持する重みのメモリ使用量(バイト、量子化した形式のまま)
+    def nbytes(self):
+        return sum(w.nbytes for w in self.kernels + self.biases + list(self.pi) + list(self.v))
+
+    # 推論中に常駐する重みのメモリ使用量(バイト、行列積用にfloat32に変換した重みを含む)
+    def resident_nbytes(self):
+        if self.matmul_kernels is self.kernels:
+            return self.nbytes()
+        return self.nbytes() + sum(w.nbytes for w in self.matmul_kernels)
+
+    # 作業用のバッファの確保(足りない場合だけ倍に拡張)
+    def reserve(self, n):
+        if n <= self.capacity:
+            return
+        self.capacity = max(n, 2 * self.capacity)
+        rows = 1 + self.capacity * SQUARE_COUNT
+        self.index = batch_im2col_index(self.capacity)
+        self.input = np.zeros((rows, INPUT_CHANNELS), dtype=np.float32)
+        self.features = [np.zeros((rows, self.filters), dtype=np.float32) for _ in range(3)]
+        self.columns = np.empty(self.capacity * SQUARE_COUNT * 9 * self.filters, dtype=np.float32)
+
+    # i番目の畳み込みの入力の変換(量子化する場合に上書き)
+    def quantize(self, x, i):
+        return x
+
+    # i番目の畳み込みの行列積
+    def matmul(self, columns, i, out):
+        np.matmul(columns, self.matmul_kernels[i], out=out)
+
+    # 畳み込みの出力の丸め(半精度で保持する場合に上書き)
+    def round(self, y):
+        pass
+
+    # i番目の3x3の畳み込み+ReLU(1 + n * 9, c) -> (1 + n * 9, filters)、shortcutを指定するとReLUの前に足す
+    def conv(self, x, out, n, i, shortcut=None):
+        x = self.quantize(x, i)
+        c = x.shape[1]
+        columns = self.columns[:n * SQUARE_COUNT * 9 * c].reshape(n * SQUARE_COUNT * 9, c)
+        np.take(x, self.index[:len(columns)], axis=0, out=columns)
+        y = out[1:]
+        self.matmul(columns.reshape(n * SQUARE_COUNT, 9 * c), i, y)
+        y += self.biases[i]
+        if shortcut is not None:
+            y += shortcut
+        np.maximum(y, 0, out=y)
+        self.round(y)
+
+    # 入力データ(n, a, b, c)の推論 -> 方策(n, 9)と価値(n,)
+    def __call__(self, x):
+        n = len(x)
+        self.reserve(n)
+        rows = 1 + n * SQUARE_COUNT
+        inputs = self.input[:rows]
+        inputs[1:] = np.asarray(x).reshape(n * SQUARE_COUNT, INPUT_CHANNELS)
+        a, b, c = (f[:rows] for f in self.features)
+
+        # 畳み込み層
+        self.conv(inputs, a, n, 0)
+
+        # 残差ブロック
+        for i in range(1, len(self.kernels), 2):
+            self.conv(a, b, n, i)
+            self.conv(b, c, n, i + 1, shortcut=a[1:])
+            a, c = c, a
+
+        # プーリング層
+        x = a[1:].reshape(n, SQUARE_COUNT, self.filters).mean(axis=1)
+
+        # ポリシー出力(softmax)
+        logits = x @ self.pi[0] + self.pi[1]
+        p = np.exp(logits - logits.max(axis=1, keepdims=True))
+        p /= p.sum(axis=1, keepdims=True)
+
+        # バリュー出力(tanh)
+        v = np.tanh(x @ self.v[0] + self.v[1])
+        return p, v[:, 0]
+
+# 半精度のネットワーク(畳み込みの重みと出力をfloat16で保持)
+# NumPyには高速な半精度の行列積が無いので、積和は構築時にfloat32に戻した重みで計算する(出力層は小さいのでfloat32のまま)
+class Float16Network(NumpyNetwork):
+    def __init__(self, weights):
+        super().__init__(weights)
+        self.matmul_kernels = [k.astype(np.float32) for k in self.kernels]
+
+    def round(self, y):
+        np.copyto(y, y.astype(np.float16))
+
+# 8ビットのネットワーク(重みは出力チャンネルごとのスケールのint8、ReLU後の入力は事前に求めたスケールで0〜255に量子化)
+# NumPyには整数の高速な行列積が無いので、積和は疑似量子化(fake-quant)で計算する
+# 量子化した値はfloat32のまま持ち、int8の重みにスケールを掛けたfloat32の重みを構築時に1回だけ作って行列積に使う
+# 出力は本来のint8の推論とほぼ同じだが、速度と常駐するメモリはfloat32の推論と変わらない
+class Int8Network(NumpyNetwork):
+    def __init__(self, weights):
+        super().__init__(weights)
+        count = len(self.kernels)
+        self.input_scales = [float(weights['conv{}_input_scale'.format(i)]) for i in range(count)]
+        self.scales = [weights['conv{}_scale'.format(i)] for i in range(count)]
+        self.matmul_kernels = [k.astype(np.float32) * (self.input_scales[i] * self.scales[i])
+                               for i, k in enumerate(self.kernels)]
+
+    def nbytes(self):
+        return super().nbytes() + sum(s.nbytes for s in self.scales)
+
+    def reserve(self, n):
+        capacity = self.capacity
+        super().reserve(n)
+        if self.capacity != capacity:
+            self.quantized = np.empty((1 + self.capacity * SQUARE_COUNT) * self.filters, dtype=np.float32)
+
+    def quantize(self, x, i):
+        q = self.quantized[:x.size].reshape(x.shape)
+        np.multiply(x, 1 / self.input_scales[i], out=q)
+        np.rint(q, out=q)
+        np.clip(q, 0, 255, out=q)
+        return q
+
+
+# 推論の精度 -> ネットワーク
+NETWORKS = {'float32': NumpyNetwork, 'float16': Float16Network, 'int8': Int8Network}
+
+# 推論の方法 -> NumPyの推論の精度(Keras以外)
+BACKEND_PRECISIONS = {'numpy': 'float32', 'float16': 'float16', 'int8': 'int8'}
+
+# キャリブレーション用の局面(学習データの新しいものから、無ければ到達可能な全局面)
+# シャードと.historyファイルはまとめて新しい順に並べ、同名のシャードがある.historyファイルは変換済みなので除く
+def calibration_inputs(data_dir='./data/', count=NI_CALIBRATION_POSITIONS):
+    from shard import has_games, load_arrays
+    shards = {p.stem: p for p in Path(data_dir).glob('*.shard') if has_games(p)}
+    histories = {p.stem: p for p in Path(data_dir).glob('*.history') if p.stem not in shards}
+    paths = sorted({**histories, **shards}.values(), key=lambda p: p.stem, reverse=True)
+    xs = []
+    for path in paths:
+        if sum(len(x) for x in xs) >= count:
+            break
+        xs.append(np.asarray(load_arrays(path)[0], dtype=np.float32))
+    if not xs:
+        from game import canonical_states
+        from inference import encode_batch
+        states = list(canonical_states().values())
+        xs = [np.zeros((len(states), *DN_INPUT_SHAPE), dtype=np.float32)]
+        encode_batch(states, xs[0])
+    return np.concatenate(xs)[:count]
+
+# キャリブレーション用のネットワーク(畳み込みごとの入力の分布の上位パーセンタイルを記録)
+class CalibrationNetwork(NumpyNetwork):
+    def __init__(self, weights):
+        super().__init__(weights)
+        self.ranges = [0.0] * len(self.kernels)
+
+    def quantize(self, x, i):
+        self.ranges[i] = max(self.ranges[i], float(np.percentile(x[1:], NI_CALIBRATION_PERCENTILE)))
+        return x
+
+# 畳み込みごとの入力のスケールの推定
+def calibrate(weights, xs, batch_size=256):
+    network = CalibrationNetwork(weights)
+    for i in range(0, len(xs), batch_size):
+        network(xs[i:i + batch_size])
+    return [r / 255 if r > 0 else 1.0 for r in network.ranges]
+
+# float32の重みの量子化
+def quantize_weights(weights, precision, xs=None):
+    weights = dict(weights)
+    count = int(weights['conv_count'])
+    if precision == 'int8':
+        input_scales = calibrate(weights, calibration_inputs() if xs is None else xs)
+    for i in range(count):
+        name = 'conv{}_kernel'.format(i)
+        kernel = weights[name]
+        if precision == 'float16':
+            weights[name] = kernel.astype(np.float16)
+        elif precision == 'int8':
+            scale = np.abs(kernel).max(axis=0) / 127
+            scale[scale == 0] = 1.0
+            weights[name] = np.rint(kernel / scale).astype(np.int8)
+            weights['conv{}_scale'.format(i)] = scale.astype(np.float32)
+            weights['conv{}_input_scale'.format(i)] = np.float32(input_scales[i])
+    return weights
+
+# NumPyの推論器(キャッシュや全局面テーブルはKerasの推論器と共通)
+class NumpyPredictor(Predictor):
+    def trace(self, model, jit_compile):
+        return model
+
+    def predict_array(self, x):
+        return self.call(x)
+
+# モデルの識別子(Kerasの推論器や他の精度とはキャッシュのエントリを分ける)
+def numpy_model_id(path, precision='float32'):
+    return model_identity(path) + (precision,)
+
+# モデルファイルの重みの読み込み
+# 重みファイルが無いか古い場合だけTensorFlowでモデルを読み込んで書き出し、量子化する場合はその結果も保存する
+def prepare_numpy_weights(path, precision='float32'):
+    model_id = numpy_model_id(path, precision)
+    weights = load_weights(weights_path(path, precision), model_id)
+    if weights is None and precision != 'float32':
+        weights = load_weights(weights_path(path), numpy_model_id(path))
+        if weights is None:
+            from tensorflow.keras.models import load_model
+            weights = export_weights(load_model(path, compile=False), weights_path(path), numpy_model_id(path))
+        weights = quantize_weights(weights, precision)
+        save_weights(weights_path(path, precision), weights, model_id)
+    elif weights is None:
+        from tensorflow.keras.models import load_model
+        weights = export_weights(load_model(path, compile=False), weights_path(path), model_id)
+    return weights
+
+# モデルファイルの重みの読み込みと推論器の構築
+def load_numpy_predictor(path, precision='float32', cache=EVAL_CACHE, eval_table=False, save_table=False, **kwargs):
+    model_id = numpy_model_id(path, precision)
+    weights = prepare_numpy_weights(path, precision)
+    if cache is not None:
+        cache.register(str(Path(path).resolve()) + '#' + precision, model_id)
+    predictor = NumpyPredictor(NETWORKS[precision](weights), cache=cache, model_id=model_id, **kwargs)
+    if eval_table:
+        predictor.build_table(str(Path(path).with_suffix('.{}.table.npz'.format(precision))) if save_table else None)
+    return predictor
+
+# 動作確認(Kerasの出力との差)
+if __name__ == '__main__':
+    from tensorflow.keras.models import load_model
+    from inference import encode_batch
+    from game import canonical_states
+    states = list(canonical_states().values())
+    x = np.zeros((len(states), *DN_INPUT_SHAPE), dtype=np.float32)
+    encode_batch(states, x)
+    model = load_model('./model/best.h5', compile=False)
+    p, v = model.predict(x, batch_size=256, verbose=0)
+    np_p, np_v = load_numpy_predictor('./model/best.h5', cache=None).predict_array(x)
+    print('{} positions: max |dp| {:.2e}, max |dv| {:.2e}'.format(
+        len(states), np.abs(np_p - p).max(), np.abs(np_v - v[:, 0]).max()))
@@ -1,109 +1,257 @@
 from math import sqrt
 from pathlib import Path
+from collections import OrderedDict
 
 import numpy as np
-from tensorflow.keras.models import load_model
 
-from dual_network import DN_INPUT_SHAPE
-from game import State
+from game import State, LOSE_TABLE, LEGAL_ACTIONS_TABLE, FULL_MASK, canonical_key, canonical_states
+from inference import get_predictor, SYMMETRY_INDEX
+import time
 
 # モンテカルロ木探索のパラメータ
 PV_EVALUATE_COUNT = 50  # 1推論あたりのシミュレーション回数
+PV_TREE_CAPACITY = 1024 # 探索木の初期ノード数(不足すると倍に拡張)
+C_PUCT = 1.0            # アーク評価値の探索項の係数
+PV_BATCH_SIZE = 1       # 1回の推論でまとめて評価する葉ノードの最大数(1なら逐次)
+PV_VIRTUAL_LOSS = 1.0   # まとめて評価する際の仮想損失
+PV_ROOT_CACHE_PLIES = 2 # 探索結果を対局間で共有する序盤の手数
+PV_ROOT_CACHE_MODELS = 4 # 探索結果を保持するモデルの数(超えたら最も古く使われたモデルのエントリを破棄)
 
-# 推論
+# ビットボード -> 3並びを含むかどうか
+LOSE_ARRAY = np.array(LOSE_TABLE)
+
+# 推論(Kerasモデルを渡した場合は推論器を1回だけ構築して再利用)
 def predict(model, state):
-    # 推論のための入力データのシェイプ変換
-    a, b, c = DN_INPUT_SHAPE
-    x = np.array([state.pieces, state.enemy_pieces])
-    x = x.reshape(c, a, b).transpose(1, 2, 0).reshape(1, a, b, c)
-
-    # 推論
-    y = model.predict(x, batch_size=1)
-
-    # 方策の取得
-    policies = y[0][0][list(state.legal_actions())]     # 合法手のみ
-    policies /= sum(policies) if sum(policies) else 1   # 合計1の確率分布に変換
-
-    # 価値の取得
-    value = y[1][0][0]  # 価値はスカラー値
-    return policies, value
-
-# ノードのリストを試行回数のリストに変換
-def nodes_to_scores(nodes):
-    scores = []
-    for c in nodes:
-        scores.append(c.n)
-    return scores
+    return get_predictor(model).predict(state)
 
-# モンテカルロ木探索のスコアの取得
-def pv_mcts_scores(model, state, temperature):
-    # モンテカルロ木探索のノード
-    class node:
-        # ノードの初期化
-        def __init__(self, state, p):
-            self.state = state          # 状態
-            self.p = p                  # 方策
-            self.w = 0                  # 累計価値
-            self.n = 0                  # 試行回数
-            self.child_nodes = None     # 子ノードのリスト
-
-        # 局面の価値の計算
-        def evaluate(self):
-            # ゲーム終了時
-            if self.state.is_done():
-                value =  -1 if self.state.is_lose() else 0
-
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-                return value
-
-            # 子ノードが存在しない場合
-            if self.child_nodes is None:
-                # ニューラルネットワークの推論で方策と価値を取得
-                policies, value = predict(model, self.state)
-
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-
-                # 子ノードの展開
-                self.child_nodes = []
-                for action, policy in zip(self.state.legal_actions(), policies):
-                    self.child_nodes.append(node(self.state.next(action), policy))
-                return value
-            # 子ノードが存在する場合
+# 配列で管理するモンテカルロ木探索の木(ノードは整数のインデックスで参照)
+class MCTSTree:
+    def __init__(self, capacity=PV_TREE_CAPACITY):
+        self.allocate(capacity)
+        self.size = 0
+
+    # 配列の確保
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.n = np.zeros(capacity, dtype=np.float64)            # 試行回数
+        self.w = np.zeros(capacity, dtype=np.float64)            # 累計価値
+        self.p = np.zeros(capacity, dtype=np.float64)            # 方策
+        self.q = np.zeros(capacity, dtype=np.float64)            # 親ノードから見た平均価値(-w/n)
+        self.u = np.zeros(capacity, dtype=np.float64)            # アーク評価値の探索項の係数(p/(1+n))
+        self.first_child = np.zeros(capacity, dtype=np.int32)    # 先頭の子ノード(-1:未展開)
+        self.num_children = np.zeros(capacity, dtype=np.int32)   # 子ノードの数
+        self.action = np.zeros(capacity, dtype=np.int32)         # 親ノードからの行動
+        self.bits = np.zeros(capacity, dtype=np.int32)           # 自分の石のビットボード
+        self.enemy_bits = np.zeros(capacity, dtype=np.int32)     # 相手の石のビットボード
+        self.done = np.zeros(capacity, dtype=bool)               # ゲーム終了かどうか
+        self.terminal = np.zeros(capacity, dtype=np.float64)     # ゲーム終了時の価値
+
+    # 配列の拡張(既存のノードは保持)
+    def grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        old = {name: getattr(self, name) for name in TREE_ARRAYS}
+        self.allocate(capacity)
+        for name, array in old.items():
+            getattr(self, name)[:self.size] = array[:self.size]
+
+    # ルートノードを指定して木を空にする(配列は再利用)
+    def reset(self, state):
+        self.size = 1
+        self.n[0] = self.w[0] = self.p[0] = self.q[0] = self.u[0] = 0
+        self.first_child[0] = -1
+        self.num_children[0] = 0
+        self.action[0] = -1
+        self.bits[0] = state.bits
+        self.enemy_bits[0] = state.enemy_bits
+        self.done[0] = False
+        self.terminal[0] = 0
+        self.root_count = state.count
+
+    # ノードの状態の取得
+    def state(self, node, count):
+        return State.from_bits(int(self.bits[node]), int(self.enemy_bits[node]), count)
+
+    # 子ノードの展開
+    def expand(self, node, count, policies):
+        bits = int(self.bits[node])
+        enemy_bits = int(self.enemy_bits[node])
+        actions = np.array(LEGAL_ACTIONS_TABLE[~(bits | enemy_bits) & FULL_MASK], dtype=np.int32)
+        k = len(actions)
+        if self.size + k > self.capacity:
+            self.grow(self.size + k)
+
+        c = self.size
+        children = slice(c, c + k)
+        child_enemy_bits = bits | (1 << actions)
+        self.n[children] = 0
+        self.w[children] = 0
+        self.p[children] = policies
+        self.q[children] = 0
+        self.u[children] = policies
+        self.first_child[children] = -1
+        self.num_children[children] = 0
+        self.action[children] = actions
+        self.bits[children] = enemy_bits
+        self.enemy_bits[children] = child_enemy_bits
+        lose = LOSE_ARRAY[child_enemy_bits]
+        self.done[children] = lose | (count + 1 == 9)
+        self.terminal[children] = np.where(lose, -1.0, 0.0)
+        self.first_child[node] = c
+        self.num_children[node] = k
+        self.size += k
+
+    # アーク評価値が最大の子ノードを取得(子ノードの試行回数の合計は親ノードの試行回数-1)
+    def select_child(self, node):
+        c = self.first_child[node]
+        children = slice(c, c + self.num_children[node])
+        pucb = self.u[children] * (C_PUCT * sqrt(self.n[node] - 1))
+        pucb += self.q[children]
+        return c + int(pucb.argmax())
+
+    # 葉ノードまで選択(経路、葉ノード、葉ノードの石の数)
+    def select_leaf(self):
+        node = 0
+        count = self.root_count
+        path = [0]
+        while self.first_child[node] >= 0:
+            node = self.select_child(node)
+            count += 1
+            path.append(node)
+            if self.done[node]:
+                break
+        return path, node, count
+
+    # 累計価値と試行回数の更新(親ノードから見た価値は符号を反転、加算済みの仮想損失は取り消す)
+    def backup(self, path, value, virtual_loss=0.0):
+        n, w, q, u, p = self.n, self.w, self.q, self.u, self.p
+        value = float(value)
+        for node in reversed(path):
+            w[node] += value - virtual_loss
+            n[node] += 1 - virtual_loss
+            q[node] = -w[node] / n[node]
+            u[node] = p[node] / (1 + n[node])
+            value = -value
+
+    # 仮想損失の加算(選択中の経路を一時的に負けとして扱い、並行する選択を分散させる)
+    def add_virtual_loss(self, path, virtual_loss):
+        n, w, q, u, p = self.n, self.w, self.q, self.u, self.p
+        for node in path:
+            w[node] += virtual_loss
+            n[node] += virtual_loss
+            q[node] = -w[node] / n[node]
+            u[node] = p[node] / (1 + n[node])
+
+    # 1回のシミュレーション(選択・展開・評価・バックアップ)
+    def simulate(self, predictor):
+        path, node, count = self.select_leaf()
+
+        # ゲーム終了時は終了時の価値、それ以外はニューラルネットワークの推論で展開
+        if self.done[node]:
+            value = self.terminal[node]
+        else:
+            policies, value = predictor.predict(self.state(node, count))
+            self.expand(node, count, policies)
+        self.backup(path, value)
+
+    # 1回のシミュレーション(評価が必要な局面をyieldし、送り返された方策と価値で展開するジェネレータ)
+    def simulate_steps(self):
+        path, node, count = self.select_leaf()
+        if self.done[node]:
+            value = self.terminal[node]
+        else:
+            policies, value = yield self.state(node, count)
+            self.expand(node, count, policies)
+        self.backup(path, value)
+
+    # 仮想損失を使って最大batch_size個の葉ノードを集め、まとめて推論するシミュレーション
+    # (終了局面はその場でバックアップし、評価待ちの葉ノードに再び到達したら打ち切る)
+    def simulate_batch(self, predictor, batch_size, virtual_loss=PV_VIRTUAL_LOSS):
+        leaves = []
+        pending = set()
+        terminals = 0
+        while terminals + len(leaves) < batch_size:
+            path, node, count = self.select_leaf()
+            if self.done[node]:
+                self.backup(path, self.terminal[node])
+                terminals += 1
+            elif node in pending:
+                break
             else:
-                # アーク評価値が最大の子ノードの評価で価値を取得
-                value = -self.next_child_node().evaluate()
+                self.add_virtual_loss(path, virtual_loss)
+                pending.add(node)
+                leaves.append((path, node, count))
 
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-                return value
+        # 葉ノードをまとめて推論して展開とバックアップ
+        if leaves:
+            states = [self.state(node, count) for _, node, count in leaves]
+            policies, values = predictor.predict_batch(states)
+            for (path, node, count), state, policy, value in zip(leaves, states, policies, values):
+                self.expand(node, count, policy[list(state.legal_actions())])
+                self.backup(path, value, virtual_loss)
+        return terminals + len(leaves)
 
-        # アーク評価値が最大の子ノードを取得
-        def next_child_node(self):
-            # アーク評価値の計算
-            C_PUCT = 1.0
-            t = sum(nodes_to_scores(self.child_nodes))
-            pucb_values = []
-            for child_node in self.child_nodes:
-                pucb_values.append((-child_node.w / child_node.n if child_node.n else 0.0) + C_PUCT * child_node.p * sqrt(t) / (1 + child_node.n))
+    # 指定回数のシミュレーションの実行(batch_sizeが2以上なら葉ノードをまとめて推論)
+    def search(self, predictor, count=PV_EVALUATE_COUNT, batch_size=PV_BATCH_SIZE):
+        if batch_size <= 1:
+            for _ in range(count):
+                self.simulate(predictor)
+            return
+        done = 0
+        while done < count:
+            done += self.simulate_batch(predictor, min(batch_size, count - done))
 
-            # アーク評価値が最大の子ノードを返す
-            return self.child_nodes[np.argmax(pucb_values)]
+    # ルートノードの子ノードの試行回数(合法手の順)
+    def root_scores(self):
+        c = self.first_child[0]
+        return self.n[c:c + self.num_children[0]].tolist()
 
+    # ルートノードから2手先までで局面が一致するノードの検索(見つからなければ-1)
+    def find(self, state, max_depth=2):
+        level = [0]
+        for depth in range(max_depth + 1):
+            for node in level:
+                if self.bits[node] == state.bits and self.enemy_bits[node] == state.enemy_bits:
+                    return node
+            level = [c for node in level if self.first_child[node] >= 0
+                     for c in range(self.first_child[node], self.first_child[node] + self.num_children[node])]
+        return -1
 
-    # 現在の局面のノードを作成
-    root_node = node(state, 0)
+    # 指定したノードを新しいルートにして、その部分木だけを配列の先頭に詰め直す(兄弟ノードは破棄)
+    def reroot(self, node, count):
+        if node != 0:
+            # 幅優先で新しい並びを決定(子ノードは連続した位置に配置)
+            src = [node]
+            first_child = []
+            i = 0
+            while i < len(src):
+                c = self.first_child[src[i]]
+                if c >= 0:
+                    first_child.append(len(src))
+                    src.extend(range(c, c + self.num_children[src[i]]))
+                else:
+                    first_child.append(-1)
+                i += 1
 
-    # 複数回の評価を実行
-    for _ in range(PV_EVALUATE_COUNT):
-        root_node.evaluate()
+            # 配列の詰め直し
+            index = np.array(src)
+            for name in TREE_ARRAYS:
+                array = getattr(self, name)
+                array[:len(src)] = array[index]
+            self.first_child[:len(src)] = first_child
+            self.action[0] = -1
+            self.size = len(src)
+        self.root_count = count
 
-    # 合法手の確率分布
-    scores = nodes_to_scores(root_node.child_nodes)
+# 探索木の配列の名前
+TREE_ARRAYS = ('n', 'w', 'p', 'q', 'u', 'first_child', 'num_children', 'action', 'bits', 'enemy_bits', 'done', 'terminal')
+
+# 探索の間で再利用する木
+_tree = MCTSTree()
+
+# 試行回数をボルツマン分布(温度0なら最大値のみ1)で確率分布に変換
+def scores_to_policy(scores, temperature):
     if temperature == 0: # 最大値の確率のみ1に設定
         action = np.argmax(scores)
         scores = np.zeros(len(scores))
@@ -112,6 +260,184 @@ def pv_mcts_scores(model, state, temperature):
         scores = boltzmann(scores, temperature)
     return scores
 
+# モンテカルロ木探索のスコアの取得
+def pv_mcts_scores(model, state, temperature, tree=None):
+    predictor = get_predictor(model)
+    tree = tree if tree is not None else _tree
+
+    # 現在の局面のノードを作成
+    tree.reset(state)
+
+    # 複数回の評価を実行
+    tree.search(predictor, PV_EVALUATE_COUNT, PV_BATCH_SIZE)
+
+    # 合法手の確率分布
+    return scores_to_policy(tree.root_scores(), temperature)
+
+# 序盤の局面の探索結果(ルートノードの子ノードの試行回数)を対局間で共有するキャッシュ
+class RootCache:
+    def __init__(self, max_plies=PV_ROOT_CACHE_PLIES, max_models=PV_ROOT_CACHE_MODELS):
+        self.max_plies = max_plies
+        self.max_models = max_models
+        self.entries = {}  # (モデルの識別子, シミュレーション回数, 正規化した局面のキー) -> 正規化した盤面の向きの試行回数(9マス)
+        self.models = OrderedDict()  # エントリのあるモデルの識別子(最近使われた順)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # キャッシュの対象の局面かどうか
+    def covers(self, state):
+        return state.count <= self.max_plies
+
+    # 試行回数(合法手の順)の取得、無ければNone
+    def get(self, predictor, count, state):
+        key, k = canonical_key(state)
+        visits = self.entries.get((predictor.model_id, count, key))
+        if predictor.model_id in self.models:
+            self.models.move_to_end(predictor.model_id)
+        if visits is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        scores = np.zeros(len(visits))
+        scores[SYMMETRY_INDEX[k]] = visits  # 問い合わせた盤面の向きに戻す
+        return scores[list(state.legal_actions())].tolist()
+
+    # 試行回数(合法手の順)の登録
+    def put(self, predictor, count, state, scores):
+        key, k = canonical_key(state)
+        visits = np.zeros(9)
+        visits[list(state.legal_actions())] = scores
+        self.entries[(predictor.model_id, count, key)] = visits[SYMMETRY_INDEX[k]]
+        self.models[predictor.model_id] = None
+        self.models.move_to_end(predictor.model_id)
+
+        # 置き換えられたモデルのエントリの破棄
+        while len(self.models) > self.max_models:
+            self.invalidate(next(iter(self.models)))
+            self.evictions += 1
+
+    # 対象の全局面を事前に探索して登録
+    def build(self, predictor, count=PV_EVALUATE_COUNT, batch_size=PV_BATCH_SIZE):
+        start = time.perf_counter()
+        tree = MCTSTree()
+        states = [s for s in canonical_states().values() if self.covers(s)]
+        for state in states:
+            tree.reset(state)
+            tree.search(predictor, count, batch_size)
+            self.put(predictor, count, state, tree.root_scores())
+        print('RootCache: {} positions, {:.3f}s'.format(len(states), time.perf_counter() - start))
+
+    # 指定したモデル(省略時は全て)のエントリの破棄
+    def invalidate(self, model_id=None):
+        if model_id is None:
+            self.entries.clear()
+            self.models.clear()
+        else:
+            for key in [key for key in self.entries if key[0] == model_id]:
+                del self.entries[key]
+            self.models.pop(model_id, None)
+
+    # 統計の出力
+    def report(self, label='RootCache'):
+        total = self.hits + self.misses
+        print('{}: size {} ({} models), hits {}, misses {}, hit rate {:.3f}, evicted models {}'.format(
+            label, len(self.entries), len(self.models), self.hits, self.misses, self.hits / total if total else 0.0,
+            self.evictions))
+
+# プロセス内で共有する序盤の探索結果のキャッシュ
+ROOT_CACHE = RootCache()
+
+# 探索結果の共有方法に応じたキャッシュの準備(None:共有しない、'lazy':探索するたびに登録、'build':事前に構築)
+def prepare_root_cache(predictor, mode, count=PV_EVALUATE_COUNT, batch_size=PV_BATCH_SIZE):
+    if mode is None:
+        return None
+    if mode == 'build':
+        ROOT_CACHE.build(get_predictor(predictor), count, batch_size)
+    return ROOT_CACHE
+
+# 手が進んでも探索木の部分木を再利用するモンテカルロ木探索
+# (root_cacheを指定すると序盤の局面の探索結果を対局間で共有)
+class MCTSSearcher:
+    def __init__(self, model, temperature=0.0, count=PV_EVALUATE_COUNT, batch_size=PV_BATCH_SIZE, root_cache=None):
+        self.predictor = get_predictor(model)
+        self.root_cache = root_cache
+        self.temperature = temperature
+        self.count = count              # 1手あたりのシミュレーション回数(再利用分を含む)
+        self.batch_size = batch_size
+        self.tree = MCTSTree()
+        self.has_root = False
+        self.inherited = []             # 1手ごとの再利用したシミュレーション回数
+
+    # 探索木の破棄
+    def reset(self):
+        self.has_root = False
+
+    # 探索の準備(序盤の探索結果が共有されていればその試行回数、無ければ探索木を用意してNone)
+    def begin(self, state):
+        if self.root_cache is not None and self.root_cache.covers(state):
+            scores = self.root_cache.get(self.predictor, self.count, state)
+            if scores is not None:
+                return scores
+
+        # 前回の探索木に局面があれば部分木を再利用
+        node = self.tree.find(state) if self.has_root else -1
+        if node >= 0:
+            self.tree.reroot(node, state.count)
+        else:
+            self.tree.reset(state)
+            self.has_root = True
+        self.inherited.append(int(self.tree.n[0]))
+        return None
+
+    # 不足しているシミュレーション回数
+    def remaining(self):
+        return max(0, self.count - int(self.tree.n[0]))
+
+    # 探索の終了(ルートノードの試行回数を共有して返す)
+    def finish(self, state):
+        scores = self.tree.root_scores()
+        if self.root_cache is not None and self.root_cache.covers(state):
+            self.root_cache.put(self.predictor, self.count, state, scores)
+        return scores
+
+    # 合法手の確率分布の取得
+    def scores(self, state, temperature=None):
+        temperature = self.temperature if temperature is None else temperature
+        scores = self.begin(state)
+        if scores is None:
+            self.tree.search(self.predictor, self.remaining(), self.batch_size)
+            scores = self.finish(state)
+        return scores_to_policy(scores, temperature)
+
+    # 合法手の確率分布の取得(評価が必要な局面をyieldし、送り返された方策と価値で探索を進めるジェネレータ)
+    def scores_steps(self, state, temperature=None):
+        temperature = self.temperature if temperature is None else temperature
+        scores = self.begin(state)
+        if scores is None:
+            for _ in range(self.remaining()):
+                yield from self.tree.simulate_steps()
+            scores = self.finish(state)
+        return scores_to_policy(scores, temperature)
+
+    # 行動選択
+    def action(self, state):
+        scores = self.scores(state)
+        return np.random.choice(list(state.legal_actions()), p=scores)
+
+    # 再利用したシミュレーション回数の出力
+    def report(self, label='MCTSSearcher'):
+        report_searchers([self], label)
+
+# 複数の探索の再利用したシミュレーション回数の出力
+def report_searchers(searchers, label='MCTSSearcher'):
+    inherited = [x for searcher in searchers for x in searcher.inherited]
+    count = searchers[0].count if searchers else 0
+    moves = len(inherited)
+    mean = sum(inherited) / moves if moves else 0.0
+    print('{}: {} moves, inherited {:.1f}/{} simulations per move ({:.1%})'.format(
+        label, moves, mean, count, mean / count if count else 0.0))
+
 # モンテカルロ木探索の行動選択
 def pv_mcts_action(model, temperature=0.0):
     def action(state):
@@ -126,15 +452,18 @@ def boltzmann(xs, temperature):
 
 # 動作確認
 if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+
     # モデルの読み込み
     path = sorted(Path('./model/').glob('*.h5'))[-1]
-    model = load_model(str(path))
+    model = load_model(str(path), compile=False)
+    predictor = get_predictor(model)
 
     # 状態の生成
     state = State()
 
     # モンテカルロ木探索で行動取得を行う関数の生成
-    next_action = pv_mcts_action(model, 1.0)
+    next_action = pv_mcts_action(predictor, 1.0)
 
     # ゲーム終了までループ
     while True:
@@ -0,0 +1,169 @@
+# 複数世代の学習データのスライディングウィンドウ(リプレイバッファ)
+# data/のシャードと.historyファイルの局面数をマニフェストに記録しておき、変更のあったファイルだけ読み直す
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
+from shard import GAMES_FILE, Shard, has_games, load_arrays
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import json
+import time
+import os
+
+# パラメータ
+RB_WINDOW_POSITIONS = 100000       # ウィンドウの最大局面数
+RB_WINDOW_GENERATIONS = 20         # ウィンドウの最大世代数(1ファイル = 1世代、Noneなら制限なし)
+RB_SAMPLING = 'uniform'            # サンプリング方法('uniform':一様、'recency':新しい世代ほど高い確率)
+RB_RECENCY_DECAY = 0.8             # 'recency'で1世代古くなるごとに掛ける重み
+RB_MEMORY_LIMIT = 256 * 1024 ** 2  # 読み込む学習データの最大バイト数
+RB_LOAD_WORKERS = 4                # 並列に読み込むファイル数
+RB_MANIFEST = 'replay_manifest.json'
+
+# 1局面あたりのバイト数(盤面int8、方策float32、価値float32)
+POSITION_BYTES = int(np.prod(DN_INPUT_SHAPE)) + DN_OUTPUT_SIZE * 4 + 4
+
+# ファイルの変更の検出に使う値(シャードはマニフェストのgames.binで判定)
+def file_stamp(path):
+    stat = os.stat(path / GAMES_FILE if path.suffix == '.shard' else path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+# ファイルの局面数
+def count_positions(path):
+    if path.suffix == '.shard':
+        return len(Shard(path))
+    return len(load_arrays(path)[2])
+
+class ReplayBuffer:
+    def __init__(self, data_dir='./data/', window_positions=RB_WINDOW_POSITIONS,
+                 window_generations=RB_WINDOW_GENERATIONS, memory_limit=RB_MEMORY_LIMIT):
+        self.data_dir = Path(data_dir)
+        self.window_positions = min(window_positions, memory_limit // POSITION_BYTES)
+        self.window_generations = window_generations
+        self.manifest_path = self.data_dir / RB_MANIFEST
+        self.manifest = self.read_manifest()  # ファイル名 -> {'stamp', 'positions'}
+        self.loaded = {}                      # ファイル名 -> (stamp, 入力, 方策, 価値)
+        self.window = []                      # [(ファイル名, 使う局面数)](古い順)
+        self.window_stamps = []
+        self.boards = self.policies = self.values = self.generations = None
+
+    def read_manifest(self):
+        if not self.manifest_path.exists():
+            return {}
+        with self.manifest_path.open() as f:
+            return json.load(f)
+
+    def write_manifest(self):
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    # 学習データのファイル一覧(同名のシャードがある.historyファイルは変換済みなので除き、ゲームの無いシャードも除く)
+    def data_paths(self):
+        shards = {p.stem: p for p in self.data_dir.glob('*.shard') if has_games(p)}
+        histories = {p.stem: p for p in self.data_dir.glob('*.history') if p.stem not in shards}
+        return sorted({**histories, **shards}.values(), key=lambda p: p.stem)
+
+    # マニフェストの更新とウィンドウの決定(新しい世代から順に局面数の上限まで)
+    def refresh(self):
+        paths = self.data_paths()
+        changed = False
+        for path in paths:
+            stamp = file_stamp(path)
+            entry = self.manifest.get(path.name)
+            if entry is None or entry['stamp'] != stamp:
+                self.manifest[path.name] = {'stamp': stamp, 'positions': count_positions(path)}
+                changed = True
+        names = {path.name for path in paths}
+        for name in [name for name in self.manifest if name not in names]:
+            del self.manifest[name]
+            changed = True
+        if changed:
+            self.write_manifest()
+
+        window = []
+        total = 0
+        for path in reversed(paths):
+            if self.window_generations is not None and len(window) >= self.window_generations:
+                break
+            if self.window_positions - total <= 0:
+                break
+            n = min(self.manifest[path.name]['positions'], self.window_positions - total)
+            if n <= 0:
+                continue  # 局面の無いファイル(ゲームが1つも終わらなかったシャードなど)は飛ばす
+            window.append((path.name, n))
+            total += n
+        window.reverse()
+        stamps = [self.manifest[name]['stamp'] for name, _ in window]
+        if window != self.window or stamps != self.window_stamps:
+            self.window = window
+            self.window_stamps = stamps
+            self.boards = None  # 次に使う時に読み込み直す
+        return self
+
+    # 1ファイルの読み込み(シャードはメモリマップ、末尾のn局面を使う)
+    def load_file(self, name, n):
+        path = self.data_dir / name
+        stamp = self.manifest[name]['stamp']
+        cached = self.loaded.get(name)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, *load_arrays(path))
+        boards, policies, values = cached[1:]
+        return cached, (boards[-n:], policies[-n:], values[-n:])
+
+    # ウィンドウ内の学習データの読み込み(初めて使う時に並列で読み込む)
+    def load(self):
+        if self.boards is not None:
+            return
+        start = time.perf_counter()
+        with ThreadPoolExecutor(RB_LOAD_WORKERS) as executor:
+            results = list(executor.map(lambda w: self.load_file(*w), self.window))
+        self.loaded = {name: cached for (name, _), (cached, _) in zip(self.window, results)}
+        parts = [arrays for _, arrays in results]
+        if parts:
+            self.boards = np.concatenate([p[0] for p in parts]).astype(np.int8)
+            self.policies = np.concatenate([p[1] for p in parts]).astype(np.float32)
+            self.values = np.concatenate([p[2] for p in parts]).astype(np.float32)
+        else:
+            self.boards = np.zeros((0, *DN_INPUT_SHAPE), dtype=np.int8)
+            self.policies = np.zeros((0, DN_OUTPUT_SIZE), dtype=np.float32)
+            self.values = np.zeros(0, dtype=np.float32)
+
+        # 局面ごとの世代(0が最新)
+        ages = np.arange(len(self.window))[::-1]
+        self.generations = np.repeat(ages, [n for _, n in self.window])
+        print('ReplayBuffer: {} positions from {} generations, {:.1f}MB, {:.3f}s'.format(
+            len(self), len(self.window), self.nbytes() / 1024 ** 2, time.perf_counter() - start))
+
+    def __len__(self):
+        return sum(n for _, n in self.window)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.boards, self.policies, self.values)) if self.boards is not None else 0
+
+    # ウィンドウ全体の学習データ(入力、方策、価値)
+    def arrays(self):
+        self.load()
+        return self.boards, self.policies, self.values
+
+    # サンプリングの確率(Noneなら一様)
+    def probabilities(self, sampling):
+        if sampling == 'uniform':
+            return None
+        if sampling == 'recency':
+            weights = RB_RECENCY_DECAY ** self.generations.astype(np.float64)
+            return weights / weights.sum()
+        raise ValueError('unknown sampling: {}'.format(sampling))
+
+    # 学習データのサンプリング(入力、方策、価値)
+    def sample(self, count, sampling=RB_SAMPLING):
+        self.load()
+        indices = np.random.choice(len(self.values), count, p=self.probabilities(sampling))
+        return self.boards[indices], self.policies[indices], self.values[indices]
+
+# 動作確認
+if __name__ == '__main__':
+    buffer = ReplayBuffer().refresh()
+    for name, n in buffer.window:
+        print('{}: {}/{} positions'.format(name, n, buffer.manifest[name]['positions']))
+    xs, y_policies, y_values = buffer.sample(8, 'recency')
+    print(xs.shape, y_policies.shape, y_values.shape)
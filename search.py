@@ -0,0 +1,167 @@
+# 置換表付きα-β探索
+from game import State, SYMMETRIES, INVERSE_SYMMETRIES, canonical_key
+import time
+
+# 置換表のエントリの種類
+EXACT = 0  # 正確な値
+LOWER = 1  # 下限値(βカット)
+UPPER = 2  # 上限値(αを超えなかった)
+
+# 着手の静的な優先順位(中央→角→辺)
+MOVE_ORDER = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+
+# 探索の打ち切り
+class SearchAbort(Exception):
+    pass
+
+# 置換表付きα-β探索エンジン(置換表は呼び出し間で再利用する)
+class AlphaBetaSearch:
+    def __init__(self, max_nodes=None, time_limit=None):
+        self.max_nodes = max_nodes    # 1回の探索あたりのノード数の上限
+        self.time_limit = time_limit  # 1回の探索あたりの時間の上限(秒)
+        self.table = {}               # 置換表(正規化した局面のキー -> (深さ, 価値, 種類, 最善手))
+        self.nodes = 0                # 累計探索ノード数
+        self.probes = 0               # 累計置換表参照回数
+        self.hits = 0                 # 累計置換表ヒット回数
+        self.cutoffs = 0              # 置換表の値をそのまま使った回数
+        self.start_nodes = 0          # 今回の探索開始時の累計ノード数
+        self.deadline = None          # 今回の探索の終了時刻
+
+    # 置換表と統計のクリア
+    def clear(self):
+        self.table.clear()
+        self.nodes = self.probes = self.hits = self.cutoffs = 0
+
+    # 着手の並べ替え(置換表の最善手→即勝ち→静的順序)
+    def ordered_actions(self, state, tt_action):
+        legal_actions = state.legal_actions()
+        first = []
+        if tt_action is not None:
+            first.append(tt_action)
+        for action in legal_actions:
+            if action != tt_action and state.next(action).is_lose():
+                first.append(action)
+        return first + [a for a in MOVE_ORDER if a in legal_actions and a not in first]
+
+    # 打ち切り条件の確認
+    def check_budget(self):
+        if self.max_nodes is not None and self.nodes - self.start_nodes >= self.max_nodes:
+            raise SearchAbort()
+        if self.deadline is not None and self.nodes % 256 == 0 and time.perf_counter() >= self.deadline:
+            raise SearchAbort()
+
+    # α-β法で状態価値計算(depthは残り深さ、打ち切り時の価値は0)
+    def alpha_beta(self, state, depth, alpha, beta):
+        self.nodes += 1
+        self.check_budget()
+
+        if state.is_lose():
+            return -1
+        elif state.is_draw():
+            return 0
+
+        # 残りのマス数を超える深さは不要(この深さなら完全に読み切る)
+        depth = min(depth, 9 - state.count)
+        if depth <= 0:
+            return 0
+
+        # 置換表の参照
+        key, k = canonical_key(state)
+        self.probes += 1
+        entry = self.table.get(key)
+        tt_action = None
+        if entry is not None:
+            self.hits += 1
+            e_depth, e_value, e_flag, e_action = entry
+            tt_action = SYMMETRIES[k][e_action]  # 正規化した盤面の手を元の盤面の手に戻す
+            if e_depth >= depth:
+                if e_flag == EXACT:
+                    self.cutoffs += 1
+                    return e_value
+                elif e_flag == LOWER:
+                    alpha = max(alpha, e_value)
+                else:
+                    beta = min(beta, e_value)
+                if alpha >= beta:
+                    self.cutoffs += 1
+                    return e_value
+
+        # 合法手の状態価値の計算
+        alpha_orig = alpha
+        best_score = -float('inf')
+        best_action = None
+        for action in self.ordered_actions(state, tt_action):
+            score = -self.alpha_beta(state.next(action), depth - 1, -beta, -alpha)
+            if score > best_score:
+                best_score = score
+                best_action = action
+            if best_score > alpha:
+                alpha = best_score
+            if alpha >= beta:  # βカット
+                break
+
+        # 置換表への登録
+        if best_score <= alpha_orig:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table[key] = (depth, best_score, flag, INVERSE_SYMMETRIES[k][best_action])
+        return best_score
+
+    # 最善手と価値の探索(予算指定時は反復深化で最後に完了した深さの結果を返す、終局した局面は最善手None)
+    def search(self, state):
+        if state.is_done():
+            return None, -1 if state.is_lose() else 0
+        self.start_nodes = self.nodes
+        self.deadline = time.perf_counter() + self.time_limit if self.time_limit is not None else None
+        max_depth = 9 - state.count
+        budgeted = self.max_nodes is not None or self.time_limit is not None
+
+        best_action, best_score = state.legal_actions()[0], 0
+        for depth in (range(1, max_depth + 1) if budgeted else [max_depth]):
+            try:
+                score = self.alpha_beta(state, depth, -2, 2)
+            except SearchAbort:
+                break
+            key, k = canonical_key(state)
+            best_action, best_score = SYMMETRIES[k][self.table[key][3]], score
+        return best_action, best_score
+
+    # 行動選択
+    def action(self, state):
+        return self.search(state)[0]
+
+    # 統計の取得
+    def stats(self):
+        return {
+            'nodes': self.nodes,
+            'probes': self.probes,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.probes if self.probes else 0.0,
+            'cutoffs': self.cutoffs,
+            'table_size': len(self.table),
+        }
+
+    # 統計の出力
+    def report(self, label='AlphaBetaSearch'):
+        s = self.stats()
+        print('{}: nodes {}, table {}, hit rate {:.3f}, cutoffs {}'.format(
+            label, s['nodes'], s['table_size'], s['hit_rate'], s['cutoffs']))
+
+# 動作確認
+if __name__ == '__main__':
+    from game import alpha_beta, random_action
+
+    # 置換表なしのα-β法と価値が一致するか確認
+    search = AlphaBetaSearch()
+    for _ in range(200):
+        state = State()
+        while True:
+            value = search.search(state)[1]
+            assert value == alpha_beta(state, -float('inf'), float('inf'))
+            if state.is_done():
+                break
+            state = state.next(random_action(state))
+    search.report()
@@ -1,17 +1,27 @@
 from game import State
-from pv_mcts import pv_mcts_scores
+from pv_mcts import MCTSSearcher, ROOT_CACHE, prepare_root_cache, report_searchers
 from dual_network import DN_OUTPUT_SIZE
+from inference import EVAL_CACHE
+from inference_server import open_predictor
+from shard import ShardWriter
 from datetime import datetime
-from tensorflow.keras.models import load_model
-from tensorflow.keras import backend as K
 from pathlib import Path
 import numpy as np
 import pickle
+import time
 import os
 
 # パラメータ
+# 常駐モード(cycle_runner)では渡された推論器を使うので、SP_RAY_WORKERS・SP_INFERENCE_SERVER・SP_BACKEND・SP_EVAL_TABLEは使わない
 SP_GAME_COUNT =20 # 自己対戦のゲーム数
 SP_TEMPERATURE = 0.1 # 温度パラメータ
+SP_EVAL_TABLE = False # 全局面の推論結果を事前に計算してモデルの隣に保存するか
+SP_ROOT_CACHE = 'lazy' # 序盤の探索結果の対局間での共有(None:しない、'lazy':随時登録、'build':読み込み時に構築)
+SP_PARALLEL_GAMES = 8 # 同時に進行するゲーム数(1なら1ゲームずつ実行)
+SP_RAY_WORKERS = 0 # Rayで分散実行するワーカー数(0なら分散しない)
+SP_INFERENCE_SERVER = None # 推論サーバーのアドレス(Noneならプロセス内で推論)
+SP_DATA_FORMAT = 'shard' # 学習データの形式('shard':ゲームごとにシャードへ追記、'history':最後にpickleで保存)
+SP_BACKEND = 'keras' # プロセス内の推論の方法('keras'、'numpy'・'float16'・'int8'ならTensorFlowを読み込まない)
 
 # 先手プレイヤーの価値
 def first_player_value(ended_state):
@@ -27,10 +37,36 @@ def write_data(history):
     with open(path, 'wb') as f:
         pickle.dump(history, f)
 
-# 1ゲームの実行
-def play(model):
+# 学習データの保存の完了(シャードは追記済みなので閉じるだけ)
+def save_data(history, writer=None):
+    if SP_DATA_FORMAT != 'shard':
+        write_data(history)
+    elif writer is None:
+        print('Saved no games')  # 1ゲームも終わらなかったのでシャードは作成していない
+    else:
+        writer.close()
+        print('Saved {} games, {} positions in {}'.format(writer.games, writer.positions, writer.path))
+
+# 学習データに状態と方策を追加
+def append_history(history, state, scores):
+    policies = [0] * DN_OUTPUT_SIZE # 方策配列の初期化
+    for action, policy in zip(state.legal_actions(), scores):
+        policies[action] = policy
+    history.append([[state.pieces, state.enemy_pieces], policies, None])
+
+# 学習データに価値を追加
+def set_history_values(history, ended_state):
+    value = first_player_value(ended_state)
+    for i in range(len(history)):
+        history[i][2] = value
+        value = -value  # 次のループではターンが変わりプレイヤーが交代するため、価値を反転する。
+
+# 1ゲームの実行(探索木は手が進んでも部分木を再利用)
+def play(model, searcher=None):
     # 学習データ
     history = []
+    if searcher is None:
+        searcher = MCTSSearcher(model, SP_TEMPERATURE)
 
     # 状態の生成
     state = State()
@@ -41,13 +77,10 @@ def play(model):
             break
 
         # 合法手の確率分布の取得
-        scores = pv_mcts_scores(model, state, SP_TEMPERATURE)
+        scores = searcher.scores(state)
 
         # 学習データに状態と方策を追加
-        policies = [0] * DN_OUTPUT_SIZE # 方策配列の初期化
-        for action, policy in zip(state.legal_actions(), scores):
-            policies[action] = policy
-        history.append([[state.pieces, state.enemy_pieces], policies, None])
+        append_history(history, state, scores)
 
         # 行動の取得
         action = np.random.choice(state.legal_actions(), p=scores)
@@ -56,35 +89,128 @@ def play(model):
         state = state.next(action)
 
     # 学習データに価値を追加
-    value = first_player_value(state)
-    for i in range(len(history)):
-        history[i][2] = value
-        value = -value  # 次のループではターンが変わりプレイヤーが交代するため、価値を反転する。
+    set_history_values(history, state)
     return history
 
-# 自己対戦の実行
-def self_play():
-    # 学習データ
+# 1ゲームの実行(評価が必要な局面をyieldし、送り返された方策と価値で進めるジェネレータ)
+def play_steps(searcher):
+    history = []
+    state = State()
+    while not state.is_done():
+        scores = yield from searcher.scores_steps(state)
+        append_history(history, state, scores)
+        state = state.next(np.random.choice(state.legal_actions(), p=scores))
+    set_history_values(history, state)
+    return history
+
+# 複数ゲームの同時進行(各ゲームの評価待ちの局面を1回の推論にまとめ、終わったゲームは新しいゲームで補充)
+def play_lockstep(predictor, game_count, parallel, root_cache=None, on_game_end=None):
+    histories = []
+    searchers = []
+    slots = []  # [探索, ジェネレータ, 評価待ちの局面]
+    started = 0
+
+    # ゲームを開始して最初の評価待ちの局面まで進める(補充できなければNone)
+    def start(searcher):
+        nonlocal started
+        while started < game_count:
+            started += 1
+            steps = play_steps(searcher)
+            try:
+                return [searcher, steps, next(steps)]
+            except StopIteration as e:
+                end_game(e.value)
+        return None
+
+    def end_game(history):
+        histories.append(history)
+        if on_game_end is not None:
+            on_game_end(len(histories), history)
+
+    for _ in range(min(parallel, game_count)):
+        searcher = MCTSSearcher(predictor, SP_TEMPERATURE, root_cache=root_cache)
+        searchers.append(searcher)
+        slot = start(searcher)
+        if slot is not None:
+            slots.append(slot)
+
+    while slots:
+        # 評価待ちの局面をまとめて推論
+        states = [slot[2] for slot in slots]
+        policies, values = predictor.predict_batch(states)
+
+        # 推論結果を送り返して次の評価待ちの局面まで進める
+        next_slots = []
+        for slot, state, policy, value in zip(slots, states, policies, values):
+            try:
+                slot[2] = slot[1].send((policy[list(state.legal_actions())], value))
+                next_slots.append(slot)
+            except StopIteration as e:
+                end_game(e.value)
+                slot = start(slot[0])
+                if slot is not None:
+                    next_slots.append(slot)
+        slots = next_slots
+    return histories, searchers
+
+# 自己対戦の実行(常駐している推論器を渡すとモデルを読み込まずにそれを使う)
+def self_play(predictor=None):
+    # 学習データ(シャードならゲームが終わるたびに追記)
     history = []
+    writer = None  # シャードは最初のゲームが終わった時点で作成(空のシャードを残さない)
+    start = time.perf_counter()
+
+    # 1ゲーム終了時の学習データの保存と出力
+    def on_game_end(i, h):
+        nonlocal writer
+        if SP_DATA_FORMAT != 'shard':
+            history.extend(h)
+        else:
+            if writer is None:
+                writer = ShardWriter()
+            writer.append_game(h)
+        print(f'\rSelf Play {i}/{SP_GAME_COUNT}', end='')
+
+    # Rayによる分散実行(ワーカーがそれぞれベストプレイヤーを読み込む)
+    if SP_RAY_WORKERS > 0 and predictor is None:
+        from self_play_ray import self_play_distributed
+        self_play_distributed(SP_GAME_COUNT, SP_RAY_WORKERS, on_game_end=on_game_end, backend=SP_BACKEND,
+                              eval_table=SP_EVAL_TABLE, root_cache=SP_ROOT_CACHE)
+        print('')
+        elapsed = time.perf_counter() - start
+        print('Self Play: {:.2f} games/sec ({} workers)'.format(SP_GAME_COUNT / elapsed, SP_RAY_WORKERS))
+        save_data(history, writer)
+        return
 
     # ベストプレイヤーの読み込み
-    model = load_model('./model/best.h5')
+    resident = predictor is not None
+    if not resident:
+        predictor = open_predictor('./model/best.h5', SP_INFERENCE_SERVER, SP_BACKEND,
+                                   eval_table=SP_EVAL_TABLE, save_table=SP_EVAL_TABLE)
+    root_cache = prepare_root_cache(predictor, SP_ROOT_CACHE)
 
     # 複数回のゲームの実行
-    for i in range(SP_GAME_COUNT):
-        h = play(model)
-        history.extend(h)
-
-        # 出力
-        print(f'\rSelf Play {i+1}/{SP_GAME_COUNT}', end='')
+    if SP_PARALLEL_GAMES > 1:
+        _, searchers = play_lockstep(predictor, SP_GAME_COUNT, SP_PARALLEL_GAMES, root_cache, on_game_end)
+    else:
+        searchers = [MCTSSearcher(predictor, SP_TEMPERATURE, root_cache=root_cache)]
+        for i in range(SP_GAME_COUNT):
+            on_game_end(i + 1, play(predictor, searchers[0]))
     print('')
+    elapsed = time.perf_counter() - start
+    print('Self Play: {:.2f} games/sec ({} parallel)'.format(SP_GAME_COUNT / elapsed, SP_PARALLEL_GAMES))
+    EVAL_CACHE.report()
+    report_searchers(searchers)
+    ROOT_CACHE.report()
 
     # 学習データの保存
-    write_data(history)
+    save_data(history, writer)
 
-    # モデルの破棄
-    K.clear_session()
-    del model
+    # モデルの破棄(常駐している推論器はそのまま)
+    if not resident and SP_BACKEND == 'keras' and SP_INFERENCE_SERVER is None:
+        from tensorflow.keras import backend as K
+        K.clear_session()
+    del predictor
 
 # 動作確認
 if __name__ == '__main__':
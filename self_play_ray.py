@@ -0,0 +1,93 @@
+# Rayによる自己対戦の分散実行(ローカルのCPUコアごとにワーカーを起動)
+from self_play import SP_GAME_COUNT, SP_PARALLEL_GAMES, SP_BACKEND, SP_EVAL_TABLE, SP_ROOT_CACHE, write_data
+import ray
+import os
+import time
+
+# パラメータ
+SR_WORKER_COUNT = os.cpu_count()  # ワーカー数
+SR_CHUNK_GAMES = 4                # ワーカーが1回に返すゲーム数
+
+# 自己対戦のワーカー(モデルと全局面テーブル、序盤の探索結果のキャッシュは起動時に1回だけ準備してゲーム間で共有)
+@ray.remote(num_cpus=1)
+class SelfPlayWorker:
+    def __init__(self, model_path, backend=SP_BACKEND, eval_table=SP_EVAL_TABLE, root_cache=SP_ROOT_CACHE):
+        # 1コアに1ワーカーなので推論のスレッドも1つに制限(NumPyの推論ならTensorFlowは読み込まない)
+        if backend == 'keras':
+            import tensorflow as tf
+            tf.config.threading.set_intra_op_parallelism_threads(1)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+
+        from inference_server import open_predictor
+        from pv_mcts import prepare_root_cache
+        # 全局面テーブルは複数のワーカーが同じファイルに同時に書かないように保存せずにワーカーごとに構築
+        self.predictor = open_predictor(model_path, backend=backend, eval_table=eval_table)
+        self.root_cache = prepare_root_cache(self.predictor, root_cache)
+
+    # 起動の確認
+    def ready(self):
+        return True
+
+    # 指定したゲーム数の自己対戦を実行して学習データを返す
+    def play(self, game_count):
+        from self_play import play_lockstep
+        histories, _ = play_lockstep(self.predictor, game_count, min(SP_PARALLEL_GAMES, game_count), self.root_cache)
+        return histories
+
+# ワーカーの起動(モデルの読み込みが終わるまで待つ)
+def start_workers(worker_count=SR_WORKER_COUNT, model_path='./model/best.h5', backend=SP_BACKEND,
+                  eval_table=SP_EVAL_TABLE, root_cache=SP_ROOT_CACHE):
+    ray.init(include_dashboard=False, ignore_reinit_error=True)
+    workers = [SelfPlayWorker.remote(model_path, backend, eval_table, root_cache) for _ in range(worker_count)]
+    ray.get([worker.ready.remote() for worker in workers])
+    return workers
+
+# ワーカーの停止
+def stop_workers(workers):
+    for worker in workers:
+        ray.kill(worker)
+
+# 自己対戦を複数のワーカーで実行し、終わったゲームから順に集める
+def play_distributed(workers, game_count=SP_GAME_COUNT, on_game_end=None):
+    # ゲームを小分けにして各ワーカーに割り当てる
+    histories = []
+    queued = 0
+    pending = {}
+    def submit(worker):
+        nonlocal queued
+        n = min(SR_CHUNK_GAMES, game_count - queued)
+        if n > 0:
+            queued += n
+            pending[worker.play.remote(n)] = worker
+    for worker in workers:
+        submit(worker)
+
+    # 終わった分から受け取って、空いたワーカーに次のゲームを割り当てる
+    while pending:
+        done, _ = ray.wait(list(pending), num_returns=1)
+        worker = pending.pop(done[0])
+        for history in ray.get(done[0]):
+            histories.append(history)
+            if on_game_end is not None:
+                on_game_end(len(histories), history)
+        submit(worker)
+    return histories
+
+# ワーカーの起動から停止までをまとめて実行
+def self_play_distributed(game_count=SP_GAME_COUNT, worker_count=SR_WORKER_COUNT,
+                          model_path='./model/best.h5', on_game_end=None, backend=SP_BACKEND,
+                          eval_table=SP_EVAL_TABLE, root_cache=SP_ROOT_CACHE):
+    workers = start_workers(worker_count, model_path, backend, eval_table, root_cache)
+    try:
+        return play_distributed(workers, game_count, on_game_end)
+    finally:
+        stop_workers(workers)
+
+# 動作確認
+if __name__ == '__main__':
+    start = time.perf_counter()
+    histories = self_play_distributed(on_game_end=lambda i, h: print(f'\rSelf Play {i}/{SP_GAME_COUNT}', end=''))
+    print('')
+    print('Self Play: {:.2f} games/sec ({} workers)'.format(
+        SP_GAME_COUNT / (time.perf_counter() - start), SR_WORKER_COUNT))
+    write_data([record for history in histories for record in history])
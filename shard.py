@@ -0,0 +1,202 @@
+# 学習データの列指向バイナリ形式(シャード)
+# シャードはディレクトリで、列ごとのファイルにゲームが終わるたびに追記する
+#   header.json   : 形式のバージョン、列ごとの型と形状
+#   boards.bin    : 盤面 int8 (n, a, b, c)(DN_INPUT_SHAPEの並び)
+#   policies.bin  : 方策 float16/float32 (n, 9)
+#   values.bin    : 価値 int8 (n,)
+#   games.bin     : 書き込みが完了したゲームの終端の局面数 int64 (ゲーム数,)(マニフェスト)
+# 各列を書き込んだ後にマニフェストを追記するので、書き込み途中で落ちても失うのは最後の1ゲームだけ
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pickle
+import json
+import os
+
+# パラメータ
+SH_POLICY_DTYPE = 'float16'  # 方策の型(float16 or float32)
+SH_VERSION = 1               # 形式のバージョン
+
+# 列ごとのファイル名と型(方策はヘッダーの型を使う)
+BOARDS_FILE = 'boards.bin'
+POLICIES_FILE = 'policies.bin'
+VALUES_FILE = 'values.bin'
+GAMES_FILE = 'games.bin'
+HEADER_FILE = 'header.json'
+
+# 新しいシャードのパス
+def new_shard_path():
+    return './data/{}.shard'.format(datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+# 学習データ([[自分の石, 相手の石], 方策, 価値]のリスト)を列ごとの配列に変換
+def history_to_arrays(history, policy_dtype=SH_POLICY_DTYPE):
+    a, b, c = DN_INPUT_SHAPE
+    boards = np.array([record[0] for record in history], dtype=np.int8).reshape(len(history), c, a, b)
+    boards = np.ascontiguousarray(boards.transpose(0, 2, 3, 1))  # (n, a, b, c) の形状に変換
+    policies = np.array([record[1] for record in history], dtype=policy_dtype).reshape(len(history), DN_OUTPUT_SIZE)
+    values = np.array([record[2] for record in history], dtype=np.int8)
+    return boards, policies, values
+
+# シャードへの書き込み(1ゲームずつ追記)
+class ShardWriter:
+    def __init__(self, path=None, policy_dtype=SH_POLICY_DTYPE):
+        self.path = Path(path or new_shard_path())
+        self.policy_dtype = np.dtype(policy_dtype)
+        self.games = 0
+        self.positions = 0
+
+        # 既存のシャードへの追記は形式が一致する場合だけ
+        self.path.mkdir(parents=True, exist_ok=True)
+        header = {
+            'version': SH_VERSION,
+            'boards': {'dtype': 'int8', 'shape': list(DN_INPUT_SHAPE)},
+            'policies': {'dtype': self.policy_dtype.name, 'shape': [DN_OUTPUT_SIZE]},
+            'values': {'dtype': 'int8', 'shape': []},
+        }
+        header_path = self.path / HEADER_FILE
+        if header_path.exists():
+            if read_header(self.path) != header:
+                raise ValueError('shard format mismatch: {}'.format(self.path))
+            ends = read_game_ends(self.path)
+            self.games = len(ends)
+            self.positions = int(ends[-1]) if len(ends) else 0
+        else:
+            with header_path.open('w') as f:
+                json.dump(header, f)
+
+        # 最後のゲームが書き込み途中で終わっていれば切り捨てる
+        self.files = {}
+        for name, dtype, shape in self.columns():
+            f = open(self.path / name, 'ab')
+            f.truncate(self.positions * dtype.itemsize * int(np.prod(shape)))
+            self.files[name] = f
+        self.files[GAMES_FILE] = open(self.path / GAMES_FILE, 'ab')
+
+    def columns(self):
+        return ((BOARDS_FILE, np.dtype(np.int8), DN_INPUT_SHAPE),
+                (POLICIES_FILE, self.policy_dtype, (DN_OUTPUT_SIZE,)),
+                (VALUES_FILE, np.dtype(np.int8), ()))
+
+    # 1ゲーム分の学習データの追記
+    def append_game(self, history):
+        if not history:
+            return
+        for f, array in zip((self.files[BOARDS_FILE], self.files[POLICIES_FILE], self.files[VALUES_FILE]),
+                            history_to_arrays(history, self.policy_dtype)):
+            f.write(array.tobytes())
+            f.flush()
+        self.positions += len(history)
+        self.games += 1
+        f = self.files[GAMES_FILE]
+        f.write(np.int64(self.positions).tobytes())
+        f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ヘッダーの読み込み
+def read_header(path):
+    with (Path(path) / HEADER_FILE).open() as f:
+        return json.load(f)
+
+# 書き込みが完了したゲームの終端の局面数
+def read_game_ends(path):
+    games_path = Path(path) / GAMES_FILE
+    if not games_path.exists():
+        return np.zeros(0, dtype=np.int64)
+    data = games_path.read_bytes()
+    return np.frombuffer(data[:len(data) // 8 * 8], dtype=np.int64)  # 書き込み途中の末尾は無視
+
+# 列のメモリマップ(先頭からn局面分、コピーしない)
+def map_column(path, dtype, shape, n):
+    if n == 0:
+        return np.zeros((0, *shape), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(n, *shape))
+
+# シャードの読み込み
+class Shard:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header = read_header(self.path)
+        if self.header['version'] != SH_VERSION:
+            raise ValueError('unsupported shard version: {}'.format(self.header['version']))
+        self.game_ends = read_game_ends(self.path)
+        n = int(self.game_ends[-1]) if len(self.game_ends) else 0
+        columns = {}
+        for name, file in (('boards', BOARDS_FILE), ('policies', POLICIES_FILE), ('values', VALUES_FILE)):
+            spec = self.header[name]
+            columns[name] = map_column(self.path / file, np.dtype(spec['dtype']), tuple(spec['shape']), n)
+        self.boards = columns['boards']      # (n, a, b, c) int8
+        self.policies = columns['policies']  # (n, 9)
+        self.values = columns['values']      # (n,) int8
+
+    def __len__(self):
+        return len(self.values)
+
+    # ゲーム数
+    @property
+    def game_count(self):
+        return len(self.game_ends)
+
+    # 学習用の配列(入力、方策、価値)
+    def arrays(self):
+        return self.boards, self.policies, self.values
+
+# シャードの読み込み(入力、方策、価値の配列)
+def load_shard(path):
+    return Shard(path).arrays()
+
+# .historyファイルのシャードへの変換(ゲームの区切りは石の数が0に戻る所から復元)
+def convert_history(history_path, shard_path=None, policy_dtype=SH_POLICY_DTYPE):
+    history_path = Path(history_path)
+    shard_path = Path(shard_path or history_path.with_suffix('.shard'))
+    with history_path.open('rb') as f:
+        history = pickle.load(f)
+    with ShardWriter(shard_path, policy_dtype) as writer:
+        if writer.positions:
+            return shard_path  # 変換済み
+        game = []
+        for record in history:
+            stones = sum(record[0][0]) + sum(record[0][1])
+            if game and stones == 0:
+                writer.append_game(game)
+                game = []
+            game.append(record)
+        writer.append_game(game)
+    return shard_path
+
+# 書き込みが完了したゲームがあるシャードか(作成直後や1ゲーム目の途中で終わったシャードは除く)
+def has_games(path):
+    return len(read_game_ends(path)) > 0
+
+# 最新の学習データのパス(シャードと.historyファイルのうち新しい方)
+def latest_data_path(data_dir='./data/'):
+    paths = [p for p in Path(data_dir).glob('*.shard') if has_games(p)] + list(Path(data_dir).glob('*.history'))
+    return max(paths, key=lambda p: (p.stem, p.suffix == '.shard'))
+
+# 学習データの読み込み(入力、方策、価値の配列)
+def load_arrays(path):
+    path = Path(path)
+    if path.suffix == '.shard':
+        return load_shard(path)
+    with path.open('rb') as f:
+        return history_to_arrays(pickle.load(f), np.float32)
+
+# 動作確認(data/*.historyをシャードに変換)
+if __name__ == '__main__':
+    for history_path in sorted(Path('./data/').glob('*.history')):
+        before = os.path.getsize(history_path)
+        shard_path = convert_history(history_path)
+        shard = Shard(shard_path)
+        after = sum(os.path.getsize(p) for p in shard_path.iterdir())
+        print('{} -> {}: {} games, {} positions, {} -> {} bytes'.format(
+            history_path.name, shard_path.name, shard.game_count, len(shard), before, after))
@@ -0,0 +1,152 @@
+# 全局面の完全解析テーブル(テーブルベース)
+from game import State, SYMMETRIES, canonical_key
+from pathlib import Path
+import numpy as np
+import pickle
+import random
+import os
+import time
+
+# パラメータ
+TB_PATH = './data/tablebase.npz'  # テーブルベースの保存先
+
+# 全局面の完全解析(正規化した局面のキー -> (価値, 最善手のビットマスク, 終局までの手数))
+def solve_all():
+    table = {}
+
+    def solve(state):
+        key, k = canonical_key(state)
+        if key in table:
+            return table[key]
+
+        # ゲーム終了時
+        if state.is_done():
+            entry = (-1 if state.is_lose() else 0, 0, 0)
+            table[key] = entry
+            return entry
+
+        # 合法手の価値と手数の計算
+        results = []
+        for action in state.legal_actions():
+            value, _, distance = solve(state.next(action))
+            results.append((action, -value, distance + 1))
+        value = max(r[1] for r in results)
+
+        # 最善手(価値が最大の手)を正規化した盤面の座標で記録
+        best = 0
+        for action, v, _ in results:
+            if v == value:
+                best |= 1 << SYMMETRIES[k].index(action)
+
+        # 勝ちは最短、負けは最長の手数
+        distances = [d for _, v, d in results if v == value]
+        distance = min(distances) if value > 0 else max(distances)
+
+        entry = (value, best, distance)
+        table[key] = entry
+        return entry
+
+    solve(State())
+    return table
+
+# テーブルベースの生成と保存
+def build_tablebase(path=TB_PATH):
+    start = time.perf_counter()
+    table = solve_all()
+    keys = np.array(sorted(table), dtype=np.uint32)
+    entries = [table[key] for key in keys.tolist()]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # 書き込み途中のファイルを読まれないように一時ファイルから置き換える
+    tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+    np.savez(tmp_path,
+             keys=keys,
+             values=np.array([e[0] for e in entries], dtype=np.int8),
+             best=np.array([e[1] for e in entries], dtype=np.uint16),
+             distances=np.array([e[2] for e in entries], dtype=np.int8))
+    os.replace(tmp_path, path)
+    print('Tablebase: {} positions, {:.3f}s -> {}'.format(len(keys), time.perf_counter() - start, path))
+
+# テーブルベース
+class Tablebase:
+    def __init__(self, keys, values, best, distances):
+        self.index = {key: i for i, key in enumerate(keys.tolist())}
+        self.values = values.tolist()
+        self.best = best.tolist()
+        self.distances = distances.tolist()
+
+    def __len__(self):
+        return len(self.index)
+
+    # 局面の価値(手番側から見て 1:勝ち、0:引き分け、-1:負け)、最善手のリスト、終局までの手数
+    def lookup(self, state):
+        key, k = canonical_key(state)
+        i = self.index[key]
+        best = self.best[i]
+        perm = SYMMETRIES[k]
+        best_actions = [perm[c] for c in range(9) if best >> c & 1]  # 元の盤面の座標に戻す
+        return self.values[i], best_actions, self.distances[i]
+
+    # 局面の価値
+    def value(self, state):
+        return self.values[self.index[canonical_key(state)[0]]]
+
+    # 最善手のいずれかをランダムに選択
+    def next_action(self, state):
+        return random.choice(self.lookup(state)[1])
+
+    # 学習データ1件の評価
+    def audit_record(self, record):
+        (pieces, enemy_pieces), policies, _ = record
+        state = State(pieces, enemy_pieces)
+        _, best_actions, _ = self.lookup(state)
+        policies = np.asarray(policies, dtype=np.float64)
+        return (policies[best_actions].sum(),                  # 最善手の確率の合計
+                int(np.argmax(policies)) in best_actions)      # 確率最大の手が最善手か
+
+    # 学習データの最善手との一致度の評価
+    def audit_history(self, history):
+        masses, top1 = [], []
+        value_error = 0.0
+        for record in history:
+            mass, ok = self.audit_record(record)
+            masses.append(mass)
+            top1.append(ok)
+            (pieces, enemy_pieces), _, value = record
+            value_error += abs(value - self.value(State(pieces, enemy_pieces)))
+        n = len(history)
+        return {
+            'positions': n,
+            'best_mass': float(np.mean(masses)) if n else 0.0,  # 方策のうち最善手に割り当てた確率の平均
+            'top1': float(np.mean(top1)) if n else 0.0,          # 確率最大の手が最善手だった割合
+            'value_mae': value_error / n if n else 0.0,          # 価値の教師データと完全解析の価値の平均絶対誤差
+        }
+
+# テーブルベースの読み込み(無ければ生成)
+def load_tablebase(path=TB_PATH):
+    if not os.path.exists(path):
+        build_tablebase(path)
+    with np.load(path) as f:
+        return Tablebase(f['keys'], f['values'], f['best'], f['distances'])
+
+# 学習データファイルの評価結果の出力
+def audit_history_file(tablebase, path):
+    with Path(path).open(mode='rb') as f:
+        history = pickle.load(f)
+    result = tablebase.audit_history(history)
+    print('{}: positions {}, best mass {:.3f}, top1 {:.3f}, value MAE {:.3f}'.format(
+        Path(path).name, result['positions'], result['best_mass'], result['top1'], result['value_mae']))
+    return result
+
+# 動作確認
+if __name__ == '__main__':
+    build_tablebase()
+
+    start = time.perf_counter()
+    tablebase = load_tablebase()
+    print('Load: {:.2f}ms'.format((time.perf_counter() - start) * 1000))
+    print('Empty board:', tablebase.lookup(State()))
+
+    # 学習データの評価
+    for path in sorted(Path('./data/').glob('*.history')):
+        audit_history_file(tablebase, path)
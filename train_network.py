@@ -3,38 +3,165 @@ import tensorflow as tf
 print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
 print(tf.config.list_physical_devices())
 
-from dual_network import DN_INPUT_SHAPE
-from tensorflow.keras.callbacks import LearningRateScheduler, LambdaCallback
+from tensorflow.keras.callbacks import Callback, LearningRateScheduler, LambdaCallback
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.optimizers.schedules import PiecewiseConstantDecay
 from tensorflow.keras.models import load_model
 from tensorflow.keras import backend as K
-from pathlib import Path
+from shard import latest_data_path, load_arrays
+from replay_buffer import ReplayBuffer
+from input_pipeline import IP_AUGMENT, IP_BATCH_SIZE, make_dataset, samples_per_epoch, ThroughputLogger
+from dedup import deduplicate, report_compression
+from dual_network import load_config, save_config
 import numpy as np
-import pickle
+import math
+import time
 
 # パラメータ
 RN_EPOCHS = 100 # 学習エポック数
+RN_REPLAY_BUFFER = True # 直近の複数世代の学習データを使うか(Falseなら最新のファイルのみ)
+RN_SAMPLE_COUNT = None # リプレイバッファからサンプリングする局面数(Noneならウィンドウ全体)
+RN_PIPELINE = True # tf.dataの入力パイプライン(対称変換によるデータ拡張)を使うか
+RN_DEDUP = True # 重複局面を集約して件数を重みにするか
+RN_MAX_STEPS = 1000 # 勾配更新の最大回数(NoneならRN_EPOCHSエポックの固定スケジュール)
+RN_MAX_SECONDS = None # 学習の最大時間(秒、Noneなら制限なし)
+RN_VALIDATION_SPLIT = 0.1 # 検証に使う局面の割合
+RN_EVAL_STEPS = 50 # 検証の間隔(勾配更新の回数)
+RN_PATIENCE = 5 # 検証の損失が改善しなくなってから打ち切るまでの検証の回数
 
-# 学習データの読み込み
+# プロセス内で使い回すリプレイバッファ(前回読み込んだファイルは読み直さない)
+_replay_buffer = None
+
+# 学習データの読み込み((N, a, b, c)の入力、方策、価値の配列で返す)
 def load_data():
-    history_path = sorted(Path('./data/').glob('*.history'))[-1]  # 最新の学習データファイルを取得
-    with history_path.open(mode = 'rb') as f:
-        return pickle.load(f)
+    global _replay_buffer
+    if not RN_REPLAY_BUFFER:
+        return load_arrays(latest_data_path())  # 最新のシャードか.historyファイル
+    if _replay_buffer is None:
+        _replay_buffer = ReplayBuffer()
+    buffer = _replay_buffer.refresh()
+    if RN_SAMPLE_COUNT is None:
+        return buffer.arrays()
+    return buffer.sample(RN_SAMPLE_COUNT)
+
+# 勾配更新の回数に応じた学習率(固定スケジュールのエポック50、80と同じ割合で減衰)
+def step_schedule(max_steps):
+    return PiecewiseConstantDecay([int(max_steps * 0.5), int(max_steps * 0.8)], [0.001, 0.0005, 0.00025])
+
+# 学習データを学習用と検証用に分割
+def split_validation(arrays, validation_split=RN_VALIDATION_SPLIT):
+    n = len(arrays[0])
+    indices = np.random.permutation(n)
+    count = max(1, int(n * validation_split)) if n > 1 else 0
+    val, train = indices[:count], indices[count:]
+    return [a[train] for a in arrays], [a[val] for a in arrays]
+
+# 学習の予算(時間)の管理と検証の損失による早期終了(終了時に最良の重みに戻す)
+class TrainingBudget(Callback):
+    def __init__(self, max_seconds=RN_MAX_SECONDS, patience=RN_PATIENCE, eval_steps=RN_EVAL_STEPS):
+        super().__init__()
+        self.max_seconds = max_seconds
+        self.patience = patience
+        self.eval_steps = eval_steps
+
+    def on_train_begin(self, logs=None):
+        self.start = time.perf_counter()
+        self.steps = 0
+        self.best = math.inf
+        self.best_step = 0
+        self.best_weights = None
+        self.wait = 0
+        self.reason = 'step budget'
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        if self.steps == 1:
+            self.first_step = time.perf_counter() - self.start  # トレースを含む最初の更新の時間
+        if self.max_seconds is not None and time.perf_counter() - self.start > self.max_seconds:
+            self.reason = 'time budget'
+            self.model.stop_training = True
+
+    # 損失のキーは出力層の名前('pi'、'v')から付く(Keras 3では'loss'、'pi_loss'、'v_loss'と検証用の'val_'付き)
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        print('\rTrain {} steps: policy {:.4f}/{:.4f}, value {:.4f}/{:.4f} (train/val)'.format(
+            self.steps, logs.get('pi_loss', math.nan), logs.get('val_pi_loss', math.nan),
+            logs.get('v_loss', math.nan), logs.get('val_v_loss', math.nan)), end='')
+        val_loss = logs.get('val_loss')
+        if val_loss is None:
+            return
+        if val_loss < self.best:
+            self.best = val_loss
+            self.best_step = self.steps
+            self.best_weights = self.model.get_weights()
+            self.wait = 0
+        else:
+            self.wait += 1
+            if self.wait >= self.patience:
+                self.reason = 'early stopping'
+                self.model.stop_training = True
 
-# デュアルネットワークの学習
-def train_network():
+    def on_train_end(self, logs=None):
+        print('')
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+        self.elapsed = time.perf_counter() - self.start
+
+# 予算内での学習(検証の損失が最良の重みで終了)
+def fit_budgeted(model, xs, y_policies, y_values, sample_weights):
+    arrays = [xs, y_policies, y_values] + ([sample_weights] if sample_weights is not None else [])
+    train, val = split_validation(arrays, RN_VALIDATION_SPLIT)
+    augment = IP_AUGMENT if RN_PIPELINE else None
+    dataset = make_dataset(*train[:3], *train[3:], augment=augment).repeat()
+    val_dataset = make_dataset(*val[:3], *val[3:], augment=None, shuffle_buffer=1)
+
+    # 固定スケジュールと同じ割合で減衰する学習率
+    model.compile(loss=['categorical_crossentropy', 'mse'], optimizer=Adam(step_schedule(RN_MAX_STEPS)))
+
+    budget = TrainingBudget(RN_MAX_SECONDS, RN_PATIENCE, RN_EVAL_STEPS)
+    throughput = ThroughputLogger(batch_size=IP_BATCH_SIZE)
+    model.fit(dataset, validation_data=val_dataset, steps_per_epoch=RN_EVAL_STEPS,
+              epochs=math.ceil(RN_MAX_STEPS / RN_EVAL_STEPS), verbose=0, shuffle=False,
+              callbacks=[budget, throughput])
+
+    # 固定スケジュール(RN_EPOCHSエポック)で同じ学習データを学習した場合との時間の比較
+    # (最初の更新以外の1回あたりの時間から見積もる)
+    fixed_steps = RN_EPOCHS * math.ceil(samples_per_epoch(len(train[0]), augment) / IP_BATCH_SIZE)
+    step_seconds = (budget.elapsed - budget.first_step) / max(budget.steps - 1, 1)
+    fixed_seconds = budget.first_step + step_seconds * (fixed_steps - 1)
+    print('Train: stopped by {} after {} steps (best at {}, val loss {:.4f}), {:.2f}s'.format(
+        budget.reason, budget.steps, budget.best_step, budget.best, budget.elapsed))
+    print('Train: fixed schedule {} steps est. {:.2f}s (from the mean step time), est. saving {:+.2f}s'.format(
+        fixed_steps, fixed_seconds, fixed_seconds - budget.elapsed))
+
+# デュアルネットワークの学習(常駐しているモデルを渡すとそのモデルを学習して返し、読み込みと保存はしない)
+def train_network(model=None):
     # 学習データの読み込み
-    history = load_data()
-    xs, y_policies, y_values = zip(*history)
+    xs, y_policies, y_values = load_data()
 
-    # 入力データの整形
-    a, b, c = DN_INPUT_SHAPE
-    xs = np.array(xs)
-    xs = xs.reshape(len(xs), c, a, b).transpose(0, 2, 3, 1)  # (N, a, b, c) の形状に変換
-    y_policies = np.array(y_policies)
-    y_values = np.array(y_values)
+    # 重複局面の集約(重みは平均1に正規化して、集約前と同じ損失の大きさにする)
+    sample_weights = None
+    if RN_DEDUP:
+        count = len(xs)
+        xs, y_policies, y_values, sample_weights = deduplicate(xs, y_policies, y_values)
+        sample_weights /= sample_weights.mean()
+        report_compression('Dedup', count, len(xs))
 
     # モデルの読み込み
-    model = load_model('./model/best.h5')
+    resident = model is not None
+    if not resident:
+        model = load_model('./model/best.h5', compile=False)  # 学習の設定はこの後で指定
+
+    # 勾配更新の回数か時間の予算での学習
+    if RN_MAX_STEPS is not None:
+        fit_budgeted(model, xs, y_policies, y_values, sample_weights)
+        if resident:
+            return model
+        model.save('./model/latest.h5')
+        save_config('./model/latest.h5', load_config('./model/best.h5'))  # 構成はベストプレイヤーと同じ
+        K.clear_session()
+        del model
+        return
 
     # モデルのコンパイル
     model.compile(loss = ['categorical_crossentropy', 'mse'], optimizer = 'adam')
@@ -53,12 +180,21 @@ def train_network():
         print(f'\rTrain {epoch + 1}/{RN_EPOCHS}', end=''))
 
     # 学習の実行
-    model.fit(xs, [y_policies, y_values], epochs=RN_EPOCHS, batch_size=128, verbose=0,
-              callbacks=[lr_decay, print_callback])
+    throughput = ThroughputLogger(samples_per_epoch(len(xs), IP_AUGMENT if RN_PIPELINE else None))
+    callbacks = [lr_decay, print_callback, throughput]
+    if RN_PIPELINE:
+        dataset = make_dataset(xs, y_policies, y_values, sample_weights)
+        model.fit(dataset, epochs=RN_EPOCHS, verbose=0, shuffle=False, callbacks=callbacks)  # シャッフルはデータセット側
+    else:
+        model.fit(xs, [y_policies, y_values], epochs=RN_EPOCHS, batch_size=128, verbose=0,
+                  sample_weight=sample_weights, callbacks=callbacks)
     print("")
+    if resident:
+        return model
 
     # モデルの保存
     model.save('./model/latest.h5')
+    save_config('./model/latest.h5', load_config('./model/best.h5'))
 
     # モデルの破棄
     K.clear_session()
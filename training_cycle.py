@@ -3,21 +3,43 @@ from self_play import self_play
 from train_network import train_network
 from evaluate_network import evaluate_network
 from evaluate_best_player import evaluate_best_player
+from league import League, update_league
+from cycle_runner import CycleRunner
 
-# デュアルネットワークの作成
-dual_network()
+# パラメータ
+TC_PERSISTENT = True  # モデルを常駐させて段階間は重みをメモリで受け渡すか(Falseなら段階ごとにファイルから読み込む)
 
-for i in range(10):
-    print('Train', i, '=========================')
-    # 自己対戦
-    self_play()
+# 学習サイクルの実行(対戦のワーカープロセスはspawnでこのスクリプトを読み込み直すので、__main__の時だけ実行)
+if __name__ == '__main__':
+    # モデルを常駐させた学習サイクル
+    if TC_PERSISTENT:
+        runner = CycleRunner()
+        runner.run(10)
+        runner.timer.report('Total', runner.writer.seconds)
+    else:
+        # 段階ごとにファイルから読み込む学習サイクル
 
-    # パラメータの更新
-    train_network()
+        # デュアルネットワークの作成
+        dual_network()
 
-    # 新パラメータの評価
-    update_best_player = evaluate_network()
+        # 最初のベストプレイヤーをリーグに登録
+        if not League().checkpoints:
+            update_league()
 
-    # ベストプレイヤーの評価
-    if update_best_player:
-        evaluate_best_player()
\ No newline at end of file
+        for i in range(10):
+            print('Train', i, '=========================')
+            # 自己対戦
+            self_play()
+
+            # パラメータの更新
+            train_network()
+
+            # 新パラメータの評価
+            update_best_player = evaluate_network()
+
+            # ベストプレイヤーの評価
+            if update_best_player:
+                evaluate_best_player()
+
+                # 昇格したモデルをリーグに追加して過去のチェックポイントと対戦
+                update_league()